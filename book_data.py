@@ -0,0 +1,311 @@
+# Aim: get the data files used by the chapters, shared by all of them
+#
+# Archives are streamed to a cache directory (resuming partial downloads),
+# only the requested members are extracted, and every file is checked
+# against the SHA-256 sums in data.sha256; a cached archive that is corrupt
+# or does not match is downloaded again, once. Downloads hold a lock file and
+# files are installed through unique temporary names, so chapters running
+# at the same time can fetch the same file safely.
+#
+# Environment variables:
+#   GEOCOMPY_CACHE   where downloaded archives are kept (~/.cache/geocompy)
+#   GEOCOMPY_MIRROR  local directory with the files (data/..., output/...) or
+#                    the archives (data.zip, main.zip), tried before the network
+#
+# Regenerate the manifest after changing data/ or output/ with:
+#   python book_data.py --manifest
+
+import hashlib
+import os
+import sys
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+
+DATA_URL = 'https://github.com/geocompx/geocompy/releases/download/0.1/data.zip'
+REPO_URL = 'https://github.com/geocompx/geocompy/archive/refs/heads/main.zip'
+LANDSAT_URL = 'https://github.com/geocompx/geocompy/releases/download/0.1/landsat.tif'
+MANIFEST = Path(__file__).with_name('data.sha256')
+CHUNK = 1024 ** 2
+
+
+def _get_umask():
+    # the umask can only be read by setting it, so once, before any threads
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+UMASK = _get_umask()
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def _cache_dir():
+    return Path(os.environ.get('GEOCOMPY_CACHE', Path.home() / '.cache' / 'geocompy'))
+
+
+def _mirror_dir():
+    mirror = os.environ.get('GEOCOMPY_MIRROR')
+    return Path(mirror) if mirror else None
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def _lock(path):
+    # exclusive lock for writing `path`, held by one process at a time; the
+    # lock files live in the cache directory, not next to the data
+    key = hashlib.sha256(str(Path(path).resolve()).encode('utf-8')).hexdigest()[:16]
+    lock = _cache_dir() / 'locks' / (key + '.lock')
+    lock.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    # LK_LOCK gives up after 10 seconds
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_manifest(path=MANIFEST):
+    # {'data/world.gpkg': '<sha256>', ...}, in `sha256sum` format
+    if not Path(path).is_file():
+        return {}
+    sums = {}
+    for line in Path(path).read_text().splitlines():
+        if line.strip():
+            digest, name = line.split(maxsplit=1)
+            sums[name.strip()] = digest
+    return sums
+
+
+def write_manifest(dirs=('data', 'output'), path=MANIFEST):
+    files = sorted(p for d in dirs for p in Path(d).rglob('*') if p.is_file())
+    with open(path, 'w') as f:
+        for p in files:
+            f.write('{}  {}\n'.format(sha256(p), p.as_posix()))
+
+
+def download(url, dest):
+    # stream `url` to `dest`, resuming from `dest.part` if an earlier
+    # download was interrupted; the lock keeps other processes off `.part`.
+    # The part is only resumed with If-Range and the ETag it was started
+    # with, so bytes of two versions of the file are never joined
+    import requests
+    dest = Path(dest)
+    if dest.is_file():
+        return dest
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    with _lock(dest):
+        if dest.is_file():
+            # another process got it while we waited
+            return dest
+        part = dest.with_name(dest.name + '.part')
+        etag = dest.with_name(dest.name + '.etag')
+        done = part.stat().st_size if part.is_file() else 0
+        headers = {}
+        if done and etag.is_file():
+            headers = {'Range': 'bytes={}-'.format(done), 'If-Range': etag.read_text()}
+        with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+            if r.status_code == 416:
+                # nothing left to fetch
+                pass
+            else:
+                r.raise_for_status()
+                # 200 means the server ignored the range or the file changed:
+                # start again
+                mode = 'ab' if r.status_code == 206 else 'wb'
+                if mode == 'wb':
+                    tag = r.headers.get('ETag')
+                    if tag and not tag.startswith('W/'):
+                        etag.write_text(tag)
+                    elif etag.is_file():
+                        etag.unlink()
+                with open(part, mode) as f:
+                    for chunk in r.iter_content(CHUNK):
+                        f.write(chunk)
+        part.replace(dest)
+        if etag.is_file():
+            etag.unlink()
+    return dest
+
+
+def _archive(url, use_mirror=True):
+    name = url.rsplit('/', 1)[-1]
+    mirror = _mirror_dir() if use_mirror else None
+    if mirror and (mirror / name).is_file():
+        return mirror / name
+    return download(url, _cache_dir() / name)
+
+
+def _members(z):
+    # map 'data/...' and 'output/...' paths to archive entries, dropping the
+    # top-level folder that repository archives have (e.g. 'geocompy-main/')
+    members = {}
+    for info in z.infolist():
+        if info.is_dir():
+            continue
+        name = info.filename
+        if not name.startswith(('data/', 'output/')):
+            name = name.split('/', 1)[-1]
+        members[name] = info
+    return members
+
+
+def _install(src, dest, expected):
+    # copy the file object `src` to `dest`, checking its hash on the way
+    # (ChecksumError if it differs from `expected`); the temporary name is
+    # unique, so concurrent installs never mix
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=dest.name + '.', suffix='.tmp', dir=dest.parent)
+    h = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: src.read(CHUNK), b''):
+                h.update(chunk)
+                f.write(chunk)
+        if expected and h.hexdigest() != expected:
+            raise ChecksumError('{}: sha256 is {}, not {} as in {}'.format(
+                dest.as_posix(), h.hexdigest(), expected, MANIFEST.name))
+        # mkstemp makes the file private; give it the usual permissions
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _wanted(patterns, manifest):
+    if not patterns:
+        patterns = ['data/']
+    names = set()
+    for p in patterns:
+        if p.endswith('/'):
+            names.update(n for n in manifest if n.startswith(p))
+        else:
+            names.add(p)
+    return sorted(names)
+
+
+def get_data(*patterns, urls=(DATA_URL, REPO_URL)):
+    """Make sure the given files exist locally, e.g. get_data('data/', 'output/elev.tif').
+
+    Directory patterns (ending in '/') expand to the files listed in the
+    manifest. Missing files are taken from the mirror directory, then from
+    each archive in `urls` in turn.
+    """
+    manifest = read_manifest()
+    missing = [n for n in _wanted(patterns, manifest) if not Path(n).is_file()]
+    mirror = _mirror_dir()
+    if mirror:
+        for name in list(missing):
+            if (mirror / name).is_file():
+                with open(mirror / name, 'rb') as src:
+                    try:
+                        _install(src, name, manifest.get(name))
+                        missing.remove(name)
+                    except ChecksumError as e:
+                        print('Checksum mismatch in the mirror: {}'.format(e))
+    errors = []
+    for url in urls:
+        # a bad archive from the mirror or the cache is fetched again, once
+        for use_mirror in (True, False):
+            if not missing:
+                break
+            print('Attempting to get {} file(s) from {}'.format(len(missing), url))
+            try:
+                archive = _archive(url, use_mirror)
+            except OSError as e:
+                # network errors (requests' included) are OSErrors: try the next url
+                print('Could not get {}: {}'.format(url, e))
+                break
+            bad = _extract(archive, missing, manifest)
+            if not bad:
+                break
+            errors.extend(bad)
+            print('Could not use {}: {}'.format(archive, '; '.join(bad)))
+            if archive.parent == _cache_dir():
+                archive.unlink(missing_ok=True)
+    if missing:
+        raise RuntimeError('Could not get: {}'.format(', '.join(missing))
+                           + ''.join('\n  ' + e for e in errors))
+
+
+def _extract(archive, missing, manifest):
+    # install the `missing` files found in `archive`, removing them from the
+    # list; returns the problems met, such as checksum mismatches
+    bad = []
+    try:
+        with zipfile.ZipFile(archive) as z:
+            members = _members(z)
+            for name in list(missing):
+                if name in members:
+                    with z.open(members[name]) as src:
+                        try:
+                            _install(src, name, manifest.get(name))
+                            missing.remove(name)
+                        except ChecksumError as e:
+                            bad.append(str(e))
+    except zipfile.BadZipFile as e:
+        bad.append('{}: {}'.format(archive, e))
+    return bad
+
+
+def get_file(url, path):
+    # a single file published on its own, such as landsat.tif
+    path = Path(path)
+    if path.is_file():
+        return path
+    expected = read_manifest().get(path.as_posix())
+    mirror = _mirror_dir()
+    if mirror and (mirror / path).is_file():
+        with open(mirror / path, 'rb') as src:
+            try:
+                _install(src, path, expected)
+                return path
+            except ChecksumError as e:
+                print('Checksum mismatch in the mirror: {}'.format(e))
+    print('Attempting to get the data')
+    cached = download(url, _cache_dir() / path.name)
+    with open(cached, 'rb') as src:
+        try:
+            _install(src, path, expected)
+        except ChecksumError as e:
+            cached.unlink()
+            raise RuntimeError('Checksum mismatch in {}: {}'.format(url, e))
+    return path
+
+
+if __name__ == '__main__':
+    if '--manifest' in sys.argv:
+        write_manifest()
+    else:
+        get_data(*sys.argv[1:])
@@ -0,0 +1,264 @@
+# Aim: run a chapter script cell by cell, reusing the results of slow cells
+#
+# The scripts in code/chapters are nbconvert exports, split into cells by
+# '# In[ ]:' lines. A cell's cache key is its source plus a hash of the values
+# of the names it reads and of the data/ and output/ files it names (by size
+# and modification time), so a cell is only re-run when it, or something it
+# depends on, changed. The names a slow cell defines or modifies are stored in
+# .cache/cells: data frames as (Geo)Parquet, arrays as .npy, anything else
+# pickled. The least recently used entries are dropped past a size limit.
+#
+# Cells that write files or run external commands are always run.
+#
+# Usage (from the repository root):
+#   python code/cell_cache.py code/chapters/06-reproj.py
+#   python code/run_chapters.py --cell-cache
+
+import ast
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import sys
+import time
+import types
+from pathlib import Path
+
+import numpy as np
+
+from run_chapters import PATH_RE, ROOT, WRITE_CALLS
+
+CACHE_DIR = ROOT / '.cache' / 'cells'
+MAX_BYTES = 2 * 1024 ** 3
+# cells faster than this are not worth caching
+MIN_SECONDS = 0.5
+
+CELL_RE = re.compile(r'^# In\[.*\]:\s*$', re.MULTILINE)
+SIDE_EFFECTS = WRITE_CALLS + ('os.system(', 'subprocess.', 'shutil.', '.write(', 'rasterio.band(',
+                              "'w'", '"w"', "'r+'", '"r+"', 'map_to_png')
+
+
+class Unhashable(Exception):
+    pass
+
+
+def split_cells(source):
+    # code of each cell, without the markdown exported as comments
+    cells = []
+    for chunk in CELL_RE.split(source):
+        lines = [l for l in chunk.splitlines() if not l.lstrip().startswith('#')]
+        code = '\n'.join(lines).strip()
+        if code:
+            cells.append(code + '\n')
+    return cells
+
+
+def names_used(tree):
+    # (names read, names bound or modified) by a cell
+    reads, writes = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (reads if isinstance(node.ctx, ast.Load) else writes).add(node.id)
+        elif isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(node.ctx, ast.Load):
+            # gdf['x'] = ... or obj.attr = ... modifies gdf / obj
+            base = node.value
+            while isinstance(base, (ast.Attribute, ast.Subscript)):
+                base = base.value
+            if isinstance(base, ast.Name):
+                writes.add(base.id)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef, ast.AsyncFunctionDef)):
+            writes.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                writes.add((alias.asname or alias.name).split('.')[0])
+    return reads, writes
+
+
+def value_hash(obj):
+    # raises Unhashable for anything that cannot be hashed, whatever the error
+    try:
+        return _value_hash(obj)
+    except Exception:
+        raise Unhashable
+
+
+def _value_hash(obj):
+    import pandas as pd
+    h = hashlib.sha256()
+    h.update(type(obj).__qualname__.encode())
+    if isinstance(obj, types.ModuleType):
+        h.update(obj.__name__.encode())
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        h.update('{}{}'.format(obj.dtype, obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        import geopandas as gpd
+        frame = obj.to_frame() if isinstance(obj, pd.Series) else obj
+        for col in frame.columns:
+            s = frame[col]
+            h.update(str(col).encode())
+            if isinstance(s, gpd.GeoSeries):
+                h.update((s.crs.to_wkt() if s.crs else '').encode())
+                s = pd.Series(s.to_wkb(), index=s.index)
+            h.update(pd.util.hash_pandas_object(s, index=True).values.tobytes())
+    elif hasattr(obj, 'name') and hasattr(obj, 'closed') and hasattr(type(obj), 'profile'):
+        # a rasterio dataset (the class is checked, as the profile of a closed
+        # one cannot be read): identified by its file, if it is an open local one
+        if obj.closed or not os.path.isfile(obj.name):
+            raise Unhashable
+        st = os.stat(obj.name)
+        h.update('{}{}{}'.format(obj.name, st.st_mtime_ns, st.st_size).encode())
+    else:
+        h.update(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    return h.hexdigest()
+
+
+def file_stamp(name):
+    # size and modification time of a data/ or output/ file, as in value_hash
+    # for open datasets; chapters run from the repository root
+    try:
+        st = os.stat(ROOT / name)
+    except OSError:
+        return 'missing'
+    return '{}{}'.format(st.st_mtime_ns, st.st_size)
+
+
+def cell_key(source, reads, ns):
+    h = hashlib.sha256(source.encode('utf-8'))
+    for name in sorted(reads):
+        if name in ns and not name.startswith('__'):
+            h.update(name.encode())
+            h.update(value_hash(ns[name]).encode())
+    # files opened by path, e.g. pd.read_csv('data/x.csv')
+    for name in sorted(set(PATH_RE.findall(source))):
+        h.update(name.encode())
+        h.update(file_stamp(name).encode())
+    return h.hexdigest()
+
+
+def store(entry, values):
+    # write `values` to the directory `entry`; returns False if they cannot be stored
+    import pandas as pd
+    import geopandas as gpd
+    tmp = entry.with_name(entry.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    index = {}
+    try:
+        for i, (name, value) in enumerate(sorted(values.items())):
+            f = str(i)
+            if isinstance(value, types.ModuleType):
+                index[name] = ['module', value.__name__]
+                continue
+            if isinstance(value, (gpd.GeoDataFrame, pd.DataFrame)):
+                try:
+                    value.to_parquet(tmp / (f + '.parquet'))
+                    kind = 'geoparquet' if isinstance(value, gpd.GeoDataFrame) else 'parquet'
+                    index[name] = [kind, f + '.parquet']
+                    continue
+                except (ImportError, ValueError, TypeError):
+                    pass
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(tmp / (f + '.npy'), value)
+                index[name] = ['npy', f + '.npy']
+                continue
+            with open(tmp / (f + '.pkl'), 'wb') as out:
+                pickle.dump(value, out, protocol=pickle.HIGHEST_PROTOCOL)
+            index[name] = ['pickle', f + '.pkl']
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        return False
+    (tmp / 'index.json').write_text(json.dumps(index))
+    shutil.rmtree(entry, ignore_errors=True)
+    tmp.replace(entry)
+    return True
+
+
+def load(entry):
+    import importlib
+    import pandas as pd
+    import geopandas as gpd
+    values = {}
+    for name, (kind, f) in json.loads((entry / 'index.json').read_text()).items():
+        if kind == 'module':
+            values[name] = importlib.import_module(f)
+        elif kind == 'geoparquet':
+            values[name] = gpd.read_parquet(entry / f)
+        elif kind == 'parquet':
+            values[name] = pd.read_parquet(entry / f)
+        elif kind == 'npy':
+            values[name] = np.load(entry / f)
+        else:
+            with open(entry / f, 'rb') as src:
+                values[name] = pickle.load(src)
+    # mark as recently used
+    os.utime(entry)
+    return values
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    if not cache_dir.is_dir():
+        return
+    entries = []
+    for entry in cache_dir.iterdir():
+        if entry.is_dir() and not entry.name.endswith('.tmp'):
+            size = sum(f.stat().st_size for f in entry.iterdir())
+            entries.append((entry.stat().st_mtime, size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def run_cell(source, path, ns):
+    exec(compile(source, str(path), 'exec'), ns)
+
+
+def run(path, cache_dir=CACHE_DIR, min_seconds=MIN_SECONDS):
+    path = Path(path)
+    sys.path.insert(0, str(path.parent))
+    ns = {'__name__': '__main__', '__file__': str(path)}
+    hits = 0
+    for source in split_cells(path.read_text(encoding='utf-8')):
+        tree = ast.parse(source)
+        reads, writes = names_used(tree)
+        if any(marker in source for marker in SIDE_EFFECTS):
+            run_cell(source, path, ns)
+            continue
+        try:
+            key = cell_key(source, reads, ns)
+            before = {n: value_hash(ns[n]) for n in reads if n in ns and not n.startswith('__')}
+        except Unhashable:
+            run_cell(source, path, ns)
+            continue
+        entry = cache_dir / key
+        if (entry / 'index.json').is_file():
+            ns.update(load(entry))
+            hits += 1
+            continue
+        start = time.perf_counter()
+        run_cell(source, path, ns)
+        if time.perf_counter() - start < min_seconds:
+            continue
+        # names bound by the cell, plus those it changed in place
+        changed = {n for n, h in before.items() if _changed(ns.get(n), h)}
+        values = {n: ns[n] for n in writes | changed if n in ns}
+        store(entry, values)
+    evict(cache_dir)
+    print('cell cache: {} cell(s) reused'.format(hits), file=sys.stderr)
+    return ns
+
+
+def _changed(value, old):
+    try:
+        return value_hash(value) != old
+    except Unhashable:
+        return True
+
+
+if __name__ == '__main__':
+    run(sys.argv[1])
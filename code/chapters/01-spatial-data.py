@@ -141,41 +141,8 @@ pd.set_option('display.max_rows', 6)
 
 #| echo: false
 #| label: getdata
-from pathlib import Path
-import os
-import shutil
-data_path = Path('data')
-
-if data_path.is_dir():
-  pass
-  # print('path exists') # directory exists
-else:
-  print('Attempting to get and unzip the data')
-  import requests, zipfile, io
-  r = requests.get('https://github.com/geocompx/geocompy/releases/download/0.1/data.zip')
-  z = zipfile.ZipFile(io.BytesIO(r.content))
-  z.extractall('.')
-
-data_path = Path('data/cycle_hire_osm.gpkg')
-
-if data_path.is_file():
-  pass
-  # print('path exists') # directory exists
-else:
-  print('Attempting to move data')
-  r = requests.get('https://github.com/geocompx/geocompy/archive/refs/heads/main.zip')
-  z = zipfile.ZipFile(io.BytesIO(r.content))
-  z.extractall('.')
-  shutil.copytree('py-main/data', 'data', dirs_exist_ok=True) 
-
-data_path = Path('output')
-
-if data_path.is_dir():
-  pass
-  # print('path exists') # directory exists
-else:
-  print('Attempting to move data')
-  shutil.copytree('py-main/output', 'output', dirs_exist_ok=True) 
+import book_data
+book_data.get_data('data/', 'output/')
 
 
 # In[ ]:
@@ -42,18 +42,8 @@ import rasterio
 
 #| echo: false
 #| include: false
-import os
-from urllib.request import urlretrieve
-
-data_path = 'data'
-if not os.path.exists(data_path):
-  os.mkdir(data_path)
-  
-file_path = 'data/landsat.tif'
-url = 'https://github.com/geocompx/geocompy/releases/download/0.1/landsat.tif'
-if not os.path.exists(file_path):
-  print('Attempting to get the data')
-  urlretrieve(url, file_path)
+import book_data
+book_data.get_file(book_data.LANDSAT_URL, 'data/landsat.tif')
 
 
 # In[ ]:
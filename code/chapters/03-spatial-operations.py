@@ -48,17 +48,8 @@ import rasterio.features
 
 
 #| echo: false
-from pathlib import Path
-data_path = Path('data')
-file_path = Path('data/landsat.tif')
-if not file_path.exists():
-  if not data_path.is_dir():
-     os.mkdir(data_path)
-  print('Attempting to get the data')
-  import requests
-  r = requests.get('https://github.com/geocompx/geocompy/releases/download/0.1/landsat.tif')  
-  with open(file_path, 'wb') as f:
-    f.write(r.content)
+import book_data
+book_data.get_file(book_data.LANDSAT_URL, 'data/landsat.tif')
 
 
 # In[ ]:
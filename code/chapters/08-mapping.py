@@ -33,17 +33,8 @@ import book_options_pdf
 
 #| echo: false
 #| label: getdata
-from pathlib import Path
-data_path = Path("data")
-if data_path.is_dir():
-  pass
-  # print("path exists") # directory exists
-else:
-  print("Attempting to get and unzip the data")
-  import requests, zipfile, io
-  r = requests.get("https://github.com/geocompx/geocompy/releases/download/0.1/data.zip")
-  z = zipfile.ZipFile(io.BytesIO(r.content))
-  z.extractall(".")
+import book_data
+book_data.get_data('data/nz.gpkg', 'data/nz_height.gpkg', 'data/nz_elev.tif')
 
 
 # This chapter requires importing the following packages:
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse
+import shapely
+import geopandas as gpd
+
+
+def _areas(a, b):
+    return shapely.area(shapely.intersection(a, b))
+
+
+def intersection_areas(source, target, chunk_size=100_000, n_jobs=None):
+    """Areas of overlap between every intersecting pair of geometries.
+
+    Returns (source positions, target positions, areas) as arrays, leaving out
+    pairs that only touch. Candidate pairs come from one bulk STRtree query,
+    and the intersections are computed `chunk_size` pairs at a time, in
+    `n_jobs` processes when there are several chunks. Intersections are
+    only kept long enough to measure them.
+    """
+    source = np.asarray(gpd.GeoSeries(source).values, dtype=object)
+    target = np.asarray(gpd.GeoSeries(target).values, dtype=object)
+    tree = shapely.STRtree(target)
+    i, j = tree.query(source, predicate='intersects')
+    chunks = [slice(k, k + chunk_size) for k in range(0, len(i), chunk_size)]
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            parts = list(pool.map(_areas, [source[i[c]] for c in chunks], [target[j[c]] for c in chunks]))
+    else:
+        parts = [_areas(source[i[c]], target[j[c]]) for c in chunks]
+    areas = np.concatenate(parts) if parts else np.zeros(0)
+    keep = areas > 0
+    return i[keep], j[keep], areas[keep]
+
+
+def area_weights(source, target, chunk_size=100_000, n_jobs=None):
+    """Sparse (CSR) source x target matrix of overlap areas.
+
+    Computing it is the expensive, geometric part of `area_interpolate`;
+    keep it with `save_weights` and pass it (or the saved file) as `weights`
+    to transfer further columns or time steps without touching the geometries.
+    """
+    i, j, areas = intersection_areas(source, target, chunk_size, n_jobs)
+    return scipy.sparse.csr_matrix((areas, (i, j)), shape=(len(source), len(target)))
+
+
+def geometry_fingerprint(geoms):
+    # SHA-256 of the geometries' WKB, in order, and of their CRS
+    geoms = gpd.GeoSeries(getattr(geoms, 'geometry', geoms))
+    h = hashlib.sha256((geoms.crs.to_wkt() if geoms.crs else '').encode('utf-8'))
+    for wkb in shapely.to_wkb(geoms.values):
+        h.update(b'' if wkb is None else wkb)
+        h.update(b'|')
+    return h.hexdigest()
+
+
+def save_weights(path, weights, source, target):
+    """Save a matrix from `area_weights` to `path` (.npz), with fingerprints of its zones."""
+    weights = scipy.sparse.csr_matrix(weights)
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, data=weights.data, indices=weights.indices, indptr=weights.indptr,
+                            shape=weights.shape, source=geometry_fingerprint(source),
+                            target=geometry_fingerprint(target))
+
+
+def load_weights(path, source, target):
+    """Load a matrix saved with `save_weights`, checking it was made for these zones.
+
+    Raises ValueError when `source` or `target` differ (geometries, their
+    order or CRS) from the zones the matrix was computed for.
+    """
+    with np.load(path) as f:
+        for name, zones in (('source', source), ('target', target)):
+            if str(f[name]) != geometry_fingerprint(zones):
+                raise ValueError('{}: the {} zones differ from those the weights were computed for'.format(
+                    path, name))
+        return scipy.sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+
+
+def area_interpolate(source, target, extensive=(), intensive=(), weights=None,
+                     chunk_size=100_000, n_jobs=None, check=True):
+    """Transfer attributes of `source` zones to `target` zones by area of overlap.
+
+    Extensive columns (counts, such as population) are split in proportion
+    to the share of each source zone's area falling in each target zone, and
+    summed. Intensive columns (densities, rates) become the overlap-weighted
+    mean over the covered part of each target zone. Target zones that do not
+    overlap any source zone get NaN. Returns a copy of `target` with the new
+    columns, named as in `source`.
+
+    `weights` is a matrix from `area_weights` for these same source and
+    target zones, or a file saved with `save_weights` (checked against the
+    zones); each column is then a single sparse matrix-vector product.
+    """
+    if source.crs != target.crs:
+        raise ValueError('source and target must have the same CRS')
+    if isinstance(weights, (str, os.PathLike)):
+        weights = load_weights(weights, source.geometry, target.geometry)
+    elif weights is None:
+        weights = area_weights(source.geometry, target.geometry, chunk_size, n_jobs)
+    if weights.shape != (len(source), len(target)):
+        raise ValueError('weights are {} but there are {} source and {} target zones'.format(
+            weights.shape, len(source), len(target)))
+    weights_t = weights.T.tocsr()
+    covered = np.asarray(weights_t.sum(axis=1)).ravel()
+    empty = covered == 0
+    result = target.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if len(extensive):
+            values = source[list(extensive)].to_numpy(dtype=float)
+            share = values / shapely.area(source.geometry.values)[:, None]
+            out = weights_t @ share
+            out[empty] = np.nan
+            for k, col in enumerate(extensive):
+                result[col] = out[:, k]
+                if check:
+                    _check_total(col, values[:, k], out[:, k])
+        if len(intensive):
+            values = source[list(intensive)].to_numpy(dtype=float)
+            out = (weights_t @ values) / covered[:, None]
+            for k, col in enumerate(intensive):
+                result[col] = out[:, k]
+    return result
+
+
+def _check_total(col, before, after):
+    # counts are only preserved when the targets cover the sources completely
+    total, moved = np.nansum(before), np.nansum(after)
+    if not np.isclose(total, moved, rtol=1e-6):
+        warnings.warn('{!r}: total changed from {} to {} (targets do not cover all of the '
+                      'source zones)'.format(col, total, moved))
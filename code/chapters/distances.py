@@ -0,0 +1,116 @@
+import numpy as np
+import scipy.sparse
+import shapely
+
+from inputs import geometry_array
+
+# bytes of distances to compute at once
+MEMORY_BUDGET = 256 * 1024 ** 2
+
+
+def nearest_pairs(left, right, k=1, max_distance=None):
+    """Positions and distances (i, j, d) of the matches in `right` for each of `left`.
+
+    k=1: the nearest feature (all of them, if several are equally near).
+    k>1: up to the k nearest features within `max_distance`.
+    k=None: every feature within `max_distance`.
+    Features further than `max_distance` are never matched.
+    """
+    left, right = geometry_array(left), geometry_array(right)
+    tree = shapely.STRtree(right)
+    if k == 1:
+        (i, j), d = tree.query_nearest(left, max_distance=max_distance, return_distance=True, all_matches=True)
+        return i, j, d
+    if max_distance is None:
+        raise ValueError('k other than 1 needs a max_distance')
+    i, j = tree.query(left, predicate='dwithin', distance=max_distance)
+    d = shapely.distance(left[i], right[j])
+    order = np.lexsort((d, i))
+    i, j, d = i[order], j[order], d[order]
+    if k is not None:
+        # rank of each match within its group of `left` feature
+        start = np.searchsorted(i, i, side='left')
+        keep = np.arange(len(i)) - start < k
+        i, j, d = i[keep], j[keep], d[keep]
+    return i, j, d
+
+
+def nearest_join(left, right, columns, k=1, max_distance=None, aggfunc='mean'):
+    """Join `columns` of `right` onto `left` from nearby features, aggregated with `aggfunc`.
+
+    The matches are found by `nearest_pairs` and aggregated per `left`
+    feature with a pandas groupby on their positions, so no buffers or
+    dissolve are needed. E.g. the mean capacity of all stations within 20 m:
+    nearest_join(cycle_hire, cycle_hire_osm, ['capacity'], k=None, max_distance=20).
+    Returns a copy of `left` with the aggregated columns, plus 'n_matches'
+    and 'distance' (to the nearest match); unmatched rows get NaN.
+    """
+    if left.crs != right.crs:
+        raise ValueError('left and right must have the same CRS')
+    i, j, d = nearest_pairs(left, right, k, max_distance)
+    matches = right[list(columns)].iloc[j].reset_index(drop=True)
+    matches['_i'] = i
+    agg = matches.groupby('_i')[list(columns)].agg(aggfunc).reindex(np.arange(len(left)))
+    result = left.copy()
+    for col in columns:
+        result[col] = agg[col].to_numpy()
+    result['n_matches'] = np.bincount(i, minlength=len(left))
+    nearest = np.full(len(left), np.inf)
+    np.minimum.at(nearest, i, d)
+    nearest[np.isinf(nearest)] = np.nan
+    result['distance'] = nearest
+    return result
+
+
+def _block_distance(left, right):
+    # points are common enough (accessibility, facilities) to be worth doing
+    # with plain coordinate arithmetic
+    if (shapely.get_type_id(left) == 0).all() and (shapely.get_type_id(right) == 0).all():
+        a, b = shapely.get_coordinates(left), shapely.get_coordinates(right)
+        if len(a) == len(left) and len(b) == len(right):
+            return np.hypot(a[:, None, 0] - b[None, :, 0], a[:, None, 1] - b[None, :, 1])
+    return shapely.distance(left[:, None], right[None, :])
+
+
+def _row_blocks(n, m, memory_budget):
+    step = max(int(memory_budget // (8 * max(m, 1))), 1)
+    return [slice(k, min(k + step, n)) for k in range(0, n, step)]
+
+
+def distance_matrix(left, right, max_distance=None, k=None, memory_budget=MEMORY_BUDGET):
+    """Distances between every feature of `left` and every feature of `right`.
+
+    By default returns a dense len(left) x len(right) NumPy array, filled
+    in blocks of rows with broadcast `shapely.distance`, each block using
+    about `memory_budget` bytes. For large inputs ask for less:
+
+    max_distance: only pairs within this distance (found with an STRtree),
+        as a scipy CSR matrix; pairs at distance 0 are stored as explicit
+        zeros, so use the sparsity pattern, not the values, to find them.
+    k: the k nearest features of `right` for each of `left`, as two
+        len(left) x k arrays (positions, distances), nearest first.
+    """
+    left, right = geometry_array(left), geometry_array(right)
+    n, m = len(left), len(right)
+    if max_distance is not None:
+        if k is not None:
+            raise ValueError('give either max_distance or k, not both')
+        i, j = shapely.STRtree(right).query(left, predicate='dwithin', distance=max_distance)
+        d = shapely.distance(left[i], right[j])
+        return scipy.sparse.csr_matrix((d, (i, j)), shape=(n, m))
+    if k is not None:
+        k = min(k, m)
+        idx = np.empty((n, k), dtype=np.intp)
+        dist = np.empty((n, k))
+        for rows in _row_blocks(n, m, memory_budget):
+            block = _block_distance(left[rows], right)
+            part = np.argpartition(block, k - 1, axis=1)[:, :k]
+            part_d = np.take_along_axis(block, part, axis=1)
+            order = np.argsort(part_d, axis=1)
+            idx[rows] = np.take_along_axis(part, order, axis=1)
+            dist[rows] = np.take_along_axis(part_d, order, axis=1)
+        return idx, dist
+    out = np.empty((n, m))
+    for rows in _row_blocks(n, m, memory_budget):
+        out[rows] = _block_distance(left[rows], right)
+    return out
@@ -0,0 +1,238 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.ndimage
+import rasterio
+from rasterio.windows import Window
+
+CATEGORICAL = ('mode', 'majority', 'minority', 'variety')
+
+
+def _window_counts(is_class, size):
+    # number of cells of one class in the size x size window around each cell,
+    # as two exact integer 1-d passes; cells outside the raster count as none
+    dtype = np.min_scalar_type(size * size)
+    ones = np.ones(size, dtype=dtype)
+    counts = scipy.ndimage.correlate1d(is_class.astype(dtype), ones, axis=0, mode='constant')
+    return scipy.ndimage.correlate1d(counts, ones, axis=1, mode='constant')
+
+
+def _edges(size, shape):
+    # True for cells whose window extends beyond the raster
+    h = size // 2
+    out = np.zeros(shape, dtype=bool)
+    if h:
+        out[:h, :] = out[-h:, :] = True
+        out[:, :h] = out[:, -h:] = True
+    return out
+
+
+def focal_categorical(arr, stat='mode', size=3, nodata=None, edges='nan'):
+    """Focal statistic of a categorical raster over a size x size moving window.
+
+    stat: 'mode' (most common class; ties go to the smallest class, as with
+    scipy.stats.mode), 'majority' (the mode, only where it fills more than
+    half of the window's valid cells), 'minority' (least common class
+    present) or 'variety' (number of classes present).
+    Cells that are NaN or `nodata` belong to no class. Each class is counted
+    with one box filter, so the cost grows with the number of classes rather
+    than with a Python call per cell. With edges='nan' (the default), cells
+    whose window extends beyond the raster are NaN; with edges='partial',
+    they are computed from the part of the window inside the raster.
+    Returns a float array, with NaN where there is no answer.
+    """
+    if stat not in CATEGORICAL:
+        raise ValueError('stat must be one of {}, not {!r}'.format(CATEGORICAL, stat))
+    if size % 2 != 1:
+        raise ValueError('size must be odd')
+    if edges not in ('nan', 'partial'):
+        raise ValueError("edges must be 'nan' or 'partial', not {!r}".format(edges))
+    arr = np.asarray(arr)
+    valid = np.ones(arr.shape, dtype=bool)
+    if np.issubdtype(arr.dtype, np.floating):
+        valid &= ~np.isnan(arr)
+    if nodata is not None:
+        valid &= arr != nodata
+    classes = np.unique(arr[valid])
+    # best class so far and its count; ties keep the earlier (smaller) class
+    dtype = np.min_scalar_type(size * size)
+    best = np.full(arr.shape, np.nan)
+    if stat == 'minority':
+        best_count = np.full(arr.shape, np.iinfo(dtype).max, dtype=dtype)
+    else:
+        best_count = np.zeros(arr.shape, dtype=dtype)
+    variety = np.zeros(arr.shape)
+    for c in classes:
+        counts = _window_counts(valid & (arr == c), size)
+        if stat == 'variety':
+            variety += counts > 0
+            continue
+        if stat == 'minority':
+            better = (counts > 0) & (counts < best_count)
+        else:
+            better = counts > best_count
+        np.putmask(best, better, c)
+        np.putmask(best_count, better, counts)
+    if stat == 'variety':
+        out = variety
+    else:
+        out = best
+        if stat == 'majority':
+            n_valid = _window_counts(valid, size)
+            out[best_count.astype(np.int64) * 2 <= n_valid] = np.nan
+    if edges == 'nan':
+        out[_edges(size, arr.shape)] = np.nan
+    return out
+
+
+NUMERIC = ('min', 'max', 'sum', 'mean', 'std')
+# np.pad modes for edges='reflect' / 'nearest', matching scipy.ndimage's
+PAD_MODES = {'reflect': 'symmetric', 'nearest': 'edge'}
+
+
+def _focal_block(block, stat, size, kernel):
+    # `block` has a halo of size // 2 (or kernel.shape // 2) cells on each
+    # side, NaN for missing cells; returns the filtered inner part
+    valid = ~np.isnan(block)
+    filled = np.where(valid, block, 0)
+    if callable(stat):
+        out = scipy.ndimage.generic_filter(block, stat, size=size, mode='constant', cval=np.nan)
+    elif stat == 'kernel':
+        out = scipy.ndimage.correlate(filled, kernel, mode='constant')
+        out[scipy.ndimage.correlate(valid.astype(np.float64), np.abs(kernel), mode='constant') == 0] = np.nan
+    elif stat in ('min', 'max'):
+        f = scipy.ndimage.minimum_filter if stat == 'min' else scipy.ndimage.maximum_filter
+        fill = np.inf if stat == 'min' else -np.inf
+        out = f(np.where(valid, block, fill), size=size, mode='constant', cval=fill)
+        out[np.isinf(out)] = np.nan
+    else:
+        n = scipy.ndimage.uniform_filter(valid.astype(np.float64), size=size, mode='constant') * size * size
+        n = np.rint(n)
+        total = scipy.ndimage.uniform_filter(filled, size=size, mode='constant') * size * size
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if stat == 'sum':
+                out = total
+            elif stat == 'mean':
+                out = total / n
+            else:
+                sq = scipy.ndimage.uniform_filter(filled ** 2, size=size, mode='constant') * size * size
+                out = np.sqrt(np.maximum(sq / n - (total / n) ** 2, 0))
+        out[n == 0] = np.nan
+    hy, hx = (np.array(kernel.shape) // 2) if kernel is not None else (size // 2, size // 2)
+    return out[hy:out.shape[0] - hy, hx:out.shape[1] - hx]
+
+
+def tiles(height, width, block_size):
+    # the windows of a height x width grid in block_size x block_size tiles
+    return [Window(col, row, min(block_size, width - col), min(block_size, height - row))
+            for row in range(0, height, block_size) for col in range(0, width, block_size)]
+
+
+def read_halo(src, band, window, hy, hx, edges):
+    # the window plus hy rows and hx columns on each side, as float with NaN
+    # for nodata; beyond the raster either NaN or extended as `edges` says
+    r0, c0 = window.row_off - hy, window.col_off - hx
+    r1, c1 = window.row_off + window.height + hy, window.col_off + window.width + hx
+    inner = Window.from_slices((max(r0, 0), min(r1, src.height)), (max(c0, 0), min(c1, src.width)))
+    block = src.read(band, window=inner).astype(np.float64)
+    if src.nodata is not None:
+        block[block == src.nodata] = np.nan
+    pad = ((max(-r0, 0), max(r1 - src.height, 0)), (max(-c0, 0), max(c1 - src.width, 0)))
+    if edges in PAD_MODES:
+        return np.pad(block, pad, mode=PAD_MODES[edges])
+    return np.pad(block, pad, constant_values=np.nan)
+
+
+def edge_mask(window, hy, hx, height, width):
+    # True for the window's cells whose hy x hx halo extends beyond the raster
+    rows = np.arange(window.row_off, window.row_off + window.height)
+    cols = np.arange(window.col_off, window.col_off + window.width)
+    return ((rows < hy) | (rows >= height - hy))[:, None] | ((cols < hx) | (cols >= width - hx))[None, :]
+
+
+def tiled_profile(profile, block_size, **kwargs):
+    # `profile` for a tiled, compressed GeoTIFF of block_size x block_size
+    # blocks, updated with `kwargs`
+    out = dict(profile)
+    out.update(driver='GTiff', tiled=True, blockxsize=block_size, blockysize=block_size,
+               compress='deflate', BIGTIFF='IF_SAFER')
+    out.update(kwargs)
+    return out
+
+
+def map_bounded(func, items, n_threads=None):
+    # yields func(item) for each of `items` in order, computed in a pool of
+    # `n_threads` threads; only a few items are in flight at a time, so
+    # memory stays bounded
+    items = list(items)
+    n_threads = n_threads or os.cpu_count() or 1
+    with ThreadPoolExecutor(n_threads) as pool:
+        for k in range(0, len(items), 2 * n_threads):
+            yield from pool.map(func, items[k:k + 2 * n_threads])
+
+
+def map_tiles(src_path, work, windows, n_threads=None):
+    # yields (window, work(src, window)) in order, as map_bounded, where each
+    # thread reads through its own dataset handle (a list of them for a list
+    # of paths)
+    local = threading.local()
+
+    def run(window):
+        if not hasattr(local, 'src'):
+            if isinstance(src_path, (list, tuple)):
+                local.src = [rasterio.open(p) for p in src_path]
+            else:
+                local.src = rasterio.open(src_path)
+        return window, work(local.src, window)
+
+    return map_bounded(run, windows, n_threads)
+
+
+def focal_raster(src_path, dst_path, stat='mean', size=3, kernel=None, edges='nan',
+                 band=1, block_size=512, n_threads=None, **profile):
+    """Focal (moving window) filter of a raster file, written block by block to a GeoTIFF.
+
+    stat: 'min', 'max', 'sum', 'mean', 'std', 'kernel' (weighted sum with
+    the 2-d `kernel` array, as scipy.ndimage.correlate) or a function
+    taking the window's values as a 1-d array (as scipy.ndimage.generic_filter;
+    flexible but slow).
+    The raster is processed in `block_size` tiles, each read with a halo of
+    the window's half width and filtered in a pool of `n_threads` threads,
+    so memory depends on the tile size and not on the raster size.
+    Nodata and NaN cells are ignored by the statistics. `edges` decides the
+    cells whose window extends beyond the raster: 'nan' makes them NaN (as
+    the chapter does by hand), 'partial' uses the cells inside the raster,
+    'reflect' and 'nearest' extend the raster as the scipy.ndimage modes do.
+    Extra keyword arguments update the output GeoTIFF profile.
+    """
+    if stat not in NUMERIC + ('kernel',) and not callable(stat):
+        raise ValueError('stat must be one of {}, \'kernel\' or a function, not {!r}'.format(NUMERIC, stat))
+    if stat == 'kernel':
+        kernel = np.asarray(kernel, dtype=np.float64)
+        if kernel.ndim != 2 or not all(n % 2 for n in kernel.shape):
+            raise ValueError('kernel must be a 2-d array with odd sides')
+    else:
+        kernel = None
+        if size % 2 != 1:
+            raise ValueError('size must be odd')
+    if edges not in ('nan', 'partial') + tuple(PAD_MODES):
+        raise ValueError("edges must be 'nan', 'partial', 'reflect' or 'nearest', not {!r}".format(edges))
+    hy, hx = (np.array(kernel.shape) // 2) if kernel is not None else (size // 2, size // 2)
+
+    with rasterio.open(src_path) as src:
+        height, width = src.height, src.width
+        out_profile = tiled_profile(src.profile, block_size, count=1, dtype='float64', nodata=np.nan)
+    out_profile.update(profile)
+
+    def work(src, window):
+        out = _focal_block(read_halo(src, band, window, hy, hx, edges), stat, size, kernel)
+        if edges == 'nan':
+            out[edge_mask(window, hy, hx, height, width)] = np.nan
+        return out
+
+    with rasterio.open(dst_path, 'w', **out_profile) as dst:
+        for window, out in map_tiles(src_path, work, tiles(height, width, block_size), n_threads):
+            dst.write(out.astype(out_profile['dtype']), 1, window=window)
+    return dst_path
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+
+SQRT3 = np.sqrt(3)
+
+
+def grid_shape(bounds, res, kind='square'):
+    # number of (rows, columns) needed to cover `bounds`
+    xmin, ymin, xmax, ymax = bounds
+    if kind == 'square':
+        ncols = max(int(np.ceil((xmax - xmin) / res)), 1)
+        nrows = max(int(np.ceil((ymax - ymin) / res)), 1)
+    elif kind == 'hex':
+        # pointy-top hexagons `res` wide; rows are 0.75 hexagon heights apart
+        # and every other row is shifted by half a hexagon
+        dy = res * SQRT3 / 2
+        ncols = int(np.ceil((xmax - xmin) / res)) + 2
+        nrows = int(np.ceil((ymax - ymin) / dy)) + 2
+    else:
+        raise ValueError("kind must be 'square' or 'hex', not {!r}".format(kind))
+    return nrows, ncols
+
+
+def _square_cells(bounds, res, row0, row1, ncols):
+    xmin, _, _, ymax = bounds
+    rows, cols = np.meshgrid(np.arange(row0, row1), np.arange(ncols), indexing='ij')
+    x = xmin + cols.ravel() * res
+    y = ymax - rows.ravel() * res
+    return shapely.box(x, y - res, x + res, y), rows.ravel(), cols.ravel()
+
+
+def _hex_cells(bounds, res, row0, row1, ncols):
+    xmin, _, _, ymax = bounds
+    radius = res / SQRT3
+    rows, cols = np.meshgrid(np.arange(row0, row1), np.arange(ncols), indexing='ij')
+    rows, cols = rows.ravel(), cols.ravel()
+    # centres start half a cell outside the bounds so the edges are covered
+    cx = xmin + (cols - 0.5) * res + (rows % 2) * res / 2
+    cy = ymax - (rows - 0.5) * radius * 1.5
+    angles = np.deg2rad(np.arange(30, 390, 60))
+    ring = np.stack([np.cos(angles), np.sin(angles)], axis=1) * radius
+    coords = np.empty((len(cx), 7, 2))
+    coords[:, :6] = ring[None] + np.stack([cx, cy], axis=1)[:, None]
+    coords[:, 6] = coords[:, 0]
+    return shapely.polygons(coords), rows, cols
+
+
+def iter_grid(bounds, res, crs=None, kind='square', block_rows=1000):
+    """Yield a grid covering `bounds` as GeoDataFrames of `block_rows` rows.
+
+    Cells are numbered row by row from the top-left, in the 'id' column, so
+    that blocks can be written out one at a time and still have unique ids.
+    Hexagonal cells that do not intersect `bounds` are left out.
+    """
+    nrows, ncols = grid_shape(bounds, res, kind)
+    make = _square_cells if kind == 'square' else _hex_cells
+    box = shapely.box(*bounds)
+    for row0 in range(0, nrows, block_rows):
+        cells, rows, cols = make(bounds, res, row0, min(row0 + block_rows, nrows), ncols)
+        ids = rows * ncols + cols
+        if kind == 'hex':
+            sel = shapely.intersects(cells, box)
+            cells, rows, cols, ids = cells[sel], rows[sel], cols[sel], ids[sel]
+        if len(cells):
+            yield gpd.GeoDataFrame({'id': ids, 'row': rows, 'col': cols}, geometry=cells, crs=crs)
+
+
+def regular_grid(bounds, res, crs=None, kind='square'):
+    # the whole grid as one GeoDataFrame
+    blocks = list(iter_grid(bounds, res, crs=crs, kind=kind))
+    return gpd.GeoDataFrame(pd.concat(blocks, ignore_index=True), crs=crs)
+
+
+def write_grid(path, bounds, res, crs=None, kind='square', block_rows=1000, **kwargs):
+    # write a grid too large for memory to a file, one block of rows at a time
+    for i, block in enumerate(iter_grid(bounds, res, crs=crs, kind=kind, block_rows=block_rows)):
+        block.to_file(path, mode='w' if i == 0 else 'a', **kwargs)
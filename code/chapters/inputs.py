@@ -0,0 +1,19 @@
+import os
+from contextlib import nullcontext
+
+import numpy as np
+import rasterio
+import geopandas as gpd
+
+
+def open_raster(src):
+    # open a path, or use an already open dataset without closing it
+    if isinstance(src, (str, os.PathLike)):
+        return rasterio.open(src)
+    return nullcontext(src)
+
+
+def geometry_array(x):
+    # GeoSeries, GeoDataFrame or array of geometries, as a NumPy array
+    x = getattr(x, 'geometry', x)
+    return np.asarray(gpd.GeoSeries(x).values, dtype=object)
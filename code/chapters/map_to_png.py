@@ -1,18 +1,192 @@
 import folium
+import hashlib
 import os
+import re
+import shutil
+import tempfile
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
-def map_to_png(m, fname, path=None):
+from selenium.webdriver.support.ui import WebDriverWait
+
+WINDOW_SIZE = (1008, 612)
+TIMEOUT = 30
+
+# True once the page has loaded and every Leaflet tile image has finished
+# (successfully or not), so screenshots wait exactly as long as the map needs
+READY_JS = """
+if (document.readyState !== 'complete') { return false; }
+var tiles = document.querySelectorAll('img.leaflet-tile');
+for (var i = 0; i < tiles.length; i++) {
+    if (!tiles[i].complete) { return false; }
+}
+return true;
+"""
+
+# Leaflet fades tiles in after they load
+SETTLE = 0.3
+
+# Rendered PNGs are cached by a hash of the map HTML and viewport size
+CACHE_DIR = '.cache/map_to_png'
+CACHE_MAX_BYTES = 200 * 1024 ** 2
+CACHE_MAX_AGE = 90 * 24 * 3600
+
+# folium gives every element a random 32-digit hex id
+_FOLIUM_ID = re.compile(r'[0-9a-f]{32}')
+
+
+def cache_key(html, window_size=WINDOW_SIZE):
+    # number the random element ids in order of appearance, so the same map
+    # always hashes the same
+    ids = {}
+    html = _FOLIUM_ID.sub(lambda x: str(ids.setdefault(x.group(0), len(ids))), html)
+    h = hashlib.sha256(html.encode('utf-8'))
+    h.update('{}x{}'.format(*window_size).encode())
+    return h.hexdigest()
+
+
+def evict_cache(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE):
+    # drop entries older than `max_age` seconds, then the least recently used
+    # ones until the cache fits in `max_bytes`
+    if not os.path.isdir(cache_dir):
+        return
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('tmp'):
+            # being written by a renderer
+            continue
+        p = os.path.join(cache_dir, name)
+        st = os.stat(p)
+        if now - st.st_mtime > max_age:
+            os.remove(p)
+        else:
+            entries.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in entries)
+    for _, size, p in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(p)
+        total -= size
+
+
+def _new_browser():
     options = Options()
     options.add_argument("--headless")
     browser = webdriver.Firefox(options=options)
-    browser.set_window_size(1008, 612)
-    if not path:
-        path = os.getcwd()
-    # save the map, open with selenium, wait for initial load
-    m.save('{}/map.html'.format(path))
-    browser.get('file://{}/map.html'.format(path))
-    time.sleep(5)
-    browser.save_screenshot('images/{}.png'.format(fname))
-    browser.quit()
\ No newline at end of file
+    browser.set_window_size(*WINDOW_SIZE)
+    return browser
+
+
+class MapRenderer:
+    # Pool of persistent headless browsers taking (map, figure name) jobs
+    def __init__(self, workers=None, path=None, cache_dir=CACHE_DIR):
+        # scratch directory for the HTML files, the system temp dir by default
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_dir = cache_dir
+        self._local = threading.local()
+        self._browsers = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def _browser(self):
+        browser = getattr(self._local, 'browser', None)
+        if browser is None:
+            browser = _new_browser()
+            self._local.browser = browser
+            with self._lock:
+                self._browsers.append(browser)
+        return browser
+
+    def _render(self, html, fname, key):
+        browser = self._browser()
+        # a unique file per job, so concurrent renders (in this or other
+        # processes) never load each other's map
+        fd, html_path = tempfile.mkstemp(suffix='.html', prefix=fname + '-', dir=self.path)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(html)
+            browser.get('file://{}'.format(os.path.abspath(html_path)))
+            WebDriverWait(browser, TIMEOUT).until(lambda b: b.execute_script(READY_JS))
+            time.sleep(SETTLE)
+            png = 'images/{}.png'.format(fname)
+            browser.save_screenshot(png)
+        finally:
+            os.remove(html_path)
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # copy then rename, so other processes never see a partial entry
+            fd, tmp = tempfile.mkstemp(suffix='.png', dir=self.cache_dir)
+            os.close(fd)
+            shutil.copyfile(png, tmp)
+            os.replace(tmp, '{}/{}.png'.format(self.cache_dir, key))
+        return png
+
+    def _from_cache(self, fname, key):
+        cached = '{}/{}.png'.format(self.cache_dir, key)
+        if not os.path.isfile(cached):
+            return None
+        png = 'images/{}.png'.format(fname)
+        shutil.copyfile(cached, png)
+        # mark as recently used
+        os.utime(cached)
+        return png
+
+    def submit(self, m, fname):
+        # render the HTML now, so later changes to `m` do not affect the figure
+        html = m.get_root().render()
+        key = cache_key(html)
+        png = self._from_cache(fname, key) if self.cache_dir else None
+        if png:
+            future = Future()
+            future.set_result(png)
+            return future
+        return self._executor.submit(self._render, html, fname, key)
+
+    def render_all(self, jobs):
+        futures = [self.submit(m, fname) for m, fname in jobs]
+        return [f.result() for f in futures]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for browser in self._browsers:
+                browser.quit()
+            self._browsers = []
+        if self.cache_dir:
+            evict_cache(self.cache_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_renderer = None
+
+
+def _default_renderer():
+    global _renderer
+    if _renderer is None:
+        import atexit
+        _renderer = MapRenderer(workers=1)
+        atexit.register(_renderer.close)
+    return _renderer
+
+
+def map_to_png(m, fname, path=None):
+    # reuses one browser across calls instead of starting one per map
+    if path:
+        with MapRenderer(workers=1, path=path) as renderer:
+            return renderer.submit(m, fname).result()
+    return _default_renderer().submit(m, fname).result()
+
+
+def maps_to_png(jobs, workers=None, path=None):
+    # render many (map, figure name) pairs concurrently
+    with MapRenderer(workers=workers, path=path) as renderer:
+        return renderer.render_all(jobs)
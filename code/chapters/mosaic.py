@@ -0,0 +1,173 @@
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window, from_bounds
+
+from focal import map_tiles, tiled_profile, tiles
+
+METHODS = ('first', 'last', 'min', 'max', 'mean')
+GDAL_TYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16',
+              'uint32': 'UInt32', 'int32': 'Int32', 'float32': 'Float32', 'float64': 'Float64'}
+
+
+def mosaic_grid(src_paths, res=None):
+    """Transform, width and height of the grid covering all `src_paths`.
+
+    As with rasterio.merge.merge, the grid starts at the top left corner of
+    the union of the sources' bounds, with the resolution of the first
+    source unless `res` is given.
+    """
+    lefts, bottoms, rights, tops = [], [], [], []
+    crs = None
+    for path in src_paths:
+        with rasterio.open(path) as src:
+            if crs is None:
+                crs, first_res = src.crs, src.res
+            elif src.crs != crs:
+                raise ValueError('all sources must have the same CRS ({} has {})'.format(path, src.crs))
+            lefts.append(src.bounds.left)
+            bottoms.append(src.bounds.bottom)
+            rights.append(src.bounds.right)
+            tops.append(src.bounds.top)
+    xres, yres = (res, res) if np.isscalar(res) else (res or first_res)
+    left, top = min(lefts), max(tops)
+    width = int(round((max(rights) - left) / xres))
+    height = int(round((top - min(bottoms)) / yres))
+    return from_origin(left, top, xres, yres), width, height
+
+
+def _src_windows(src_paths, transform):
+    # each source's extent as a window of the mosaic grid
+    out = []
+    for path in src_paths:
+        with rasterio.open(path) as src:
+            out.append(from_bounds(*src.bounds, transform=transform).round_offsets().round_lengths())
+    return out
+
+
+def _overlap(a, b):
+    row0, col0 = max(a.row_off, b.row_off), max(a.col_off, b.col_off)
+    row1 = min(a.row_off + a.height, b.row_off + b.height)
+    col1 = min(a.col_off + a.width, b.col_off + b.width)
+    if row1 <= row0 or col1 <= col0:
+        return None
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def mosaic(src_paths, dst_path, method='first', res=None, nodata=None, dtype=None,
+           resampling=Resampling.nearest, block_size=512, n_threads=None, **profile):
+    """Merge rasters into one GeoTIFF, written window by window.
+
+    Does the job of rasterio.merge.merge (and gives the same result for the
+    default method='first') without ever holding the whole mosaic in
+    memory: the output grid (see `mosaic_grid`) is filled in `block_size`
+    tiles, each reading only the overlapping parts of the sources, and the
+    tiles are read in `n_threads` threads. `method` decides the value where
+    sources overlap: 'first' or 'last' valid value in `src_paths` order,
+    'min', 'max' or 'mean'. Sources must share a CRS and band count; those
+    with another resolution are resampled with `resampling`.
+    `nodata` and `dtype` default to those of the first source.
+    If `dst_path` ends with '.vrt', writes a GDAL virtual raster that
+    refers to the sources instead of copying them (only 'first' and 'last').
+    Extra keyword arguments update the output GeoTIFF profile.
+    """
+    if method not in METHODS:
+        raise ValueError('method must be one of {}, not {!r}'.format(METHODS, method))
+    src_paths = list(src_paths)
+    transform, width, height = mosaic_grid(src_paths, res)
+    with rasterio.open(src_paths[0]) as first:
+        out_profile = first.profile.copy()
+        count = first.count
+    nodata = out_profile['nodata'] if nodata is None else nodata
+    dtype = dtype or out_profile['dtype']
+    if str(dst_path).endswith('.vrt'):
+        if method not in ('first', 'last'):
+            raise ValueError("a VRT mosaic only supports method 'first' or 'last'")
+        return _write_vrt(src_paths, dst_path, method, transform, width, height, count, nodata, dtype)
+    src_windows = _src_windows(src_paths, transform)
+
+    def work(srcs, window):
+        value = np.full((count, window.height, window.width), np.nan)
+        n = np.zeros(value.shape, dtype=np.int64)
+        for src, src_window in zip(srcs, src_windows):
+            part = _overlap(window, src_window)
+            if part is None:
+                continue
+            if src.count != count:
+                raise ValueError('{} has {} bands, not {}'.format(src.name, src.count, count))
+            (row0, row1), (col0, col1) = part.toranges()
+            bounds = rasterio.windows.bounds(part, transform)
+            data = src.read(window=from_bounds(*bounds, transform=src.transform),
+                            out_shape=(count, part.height, part.width), resampling=resampling, masked=True)
+            ok = ~np.ma.getmaskarray(data)
+            v = data.filled(0).astype(np.float64)
+            ok &= ~np.isnan(v)
+            rows = slice(row0 - window.row_off, row1 - window.row_off)
+            cols = slice(col0 - window.col_off, col1 - window.col_off)
+            old, seen = value[:, rows, cols], n[:, rows, cols] > 0
+            if method == 'first':
+                take = ok & ~seen
+            elif method == 'min':
+                take = ok & (~seen | (v < old))
+            elif method == 'max':
+                take = ok & (~seen | (v > old))
+            else:
+                take = ok
+            if method == 'mean':
+                old[take & ~seen] = 0
+                old[take] += v[take]
+            else:
+                old[take] = v[take]
+            n[:, rows, cols] += ok
+        if method == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                value /= n
+        if np.issubdtype(np.dtype(dtype), np.floating):
+            fill = np.nan if nodata is None else nodata
+        else:
+            # no nodata: empty cells are 0, as with rasterio.merge.merge
+            value, fill = np.rint(value), 0 if nodata is None else nodata
+        value[n == 0] = fill
+        return value.astype(dtype)
+
+    out_profile = tiled_profile(out_profile, block_size, width=width, height=height, transform=transform,
+                                dtype=dtype, nodata=nodata)
+    out_profile.update(profile)
+    with rasterio.open(dst_path, 'w', **out_profile) as dst:
+        for window, out in map_tiles(src_paths, work, tiles(height, width, block_size), n_threads):
+            dst.write(out, window=window)
+    return dst_path
+
+
+def _write_vrt(src_paths, dst_path, method, transform, width, height, count, nodata, dtype):
+    # GDAL draws the sources in order, later ones over earlier ones, so
+    # 'first' lists them in reverse
+    with rasterio.open(src_paths[0]) as first:
+        crs = first.crs
+    root = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(root, 'SRS').text = crs.to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = ', '.join(repr(float(x)) for x in transform.to_gdal())
+    order = src_paths[::-1] if method == 'first' else src_paths
+    for b in range(1, count + 1):
+        band = ET.SubElement(root, 'VRTRasterBand', dataType=GDAL_TYPES[np.dtype(dtype).name], band=str(b))
+        if nodata is not None:
+            ET.SubElement(band, 'NoDataValue').text = repr(float(nodata))
+        for path in order:
+            with rasterio.open(path) as src:
+                if src.count != count:
+                    raise ValueError('{} has {} bands, not {}'.format(path, src.count, count))
+                dst_window = from_bounds(*src.bounds, transform=transform)
+                source = ET.SubElement(band, 'ComplexSource')
+                ET.SubElement(source, 'SourceFilename', relativeToVRT='0').text = os.path.abspath(path)
+                ET.SubElement(source, 'SourceBand').text = str(b)
+                ET.SubElement(source, 'SrcRect', xOff='0', yOff='0', xSize=str(src.width), ySize=str(src.height))
+                ET.SubElement(source, 'DstRect', xOff=repr(float(dst_window.col_off)), yOff=repr(float(dst_window.row_off)),
+                              xSize=repr(float(dst_window.width)), ySize=repr(float(dst_window.height)))
+                if src.nodata is not None:
+                    ET.SubElement(source, 'NODATA').text = repr(float(src.nodata))
+    ET.ElementTree(root).write(dst_path)
+    return dst_path
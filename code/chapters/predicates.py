@@ -0,0 +1,127 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+import shapely
+
+from inputs import geometry_array
+
+PREDICATES = ('intersects', 'within', 'contains', 'touches', 'crosses', 'overlaps',
+              'covers', 'covered_by', 'contains_properly', 'disjoint', 'dwithin')
+
+# `geom <predicate> mask` written as `mask <converse> geom`, so that the
+# prepared mask is the first argument
+CONVERSE = {'intersects': 'intersects', 'within': 'contains', 'covered_by': 'covers',
+            'disjoint': 'intersects'}
+
+
+def predicate_pairs(left, right, predicate='intersects', distance=None):
+    """Positions (i, j) of all pairs for which `left[i] <predicate> right[j]` holds.
+
+    One bulk STRtree query, so the cost grows with n log m rather than n * m.
+    'dwithin' needs `distance`. 'disjoint' is the complement of 'intersects'
+    and is usually dense: prefer asking for 'intersects' and negating.
+    """
+    if predicate not in PREDICATES:
+        raise ValueError('predicate must be one of {}, not {!r}'.format(PREDICATES, predicate))
+    if predicate == 'dwithin' and distance is None:
+        raise ValueError("predicate 'dwithin' needs a distance")
+    left, right = geometry_array(left), geometry_array(right)
+    tree = shapely.STRtree(right)
+    if predicate == 'disjoint':
+        hit = np.zeros((len(left), len(right)), dtype=bool)
+        i, j = tree.query(left, predicate='intersects')
+        hit[i, j] = True
+        # missing geometries are neither intersecting nor disjoint
+        hit[shapely.is_missing(left)] = True
+        hit[:, shapely.is_missing(right)] = True
+        return np.nonzero(~hit)
+    i, j = tree.query(left, predicate=predicate, distance=distance)
+    order = np.lexsort((j, i))
+    return i[order], j[order]
+
+
+def predicate_matrix(left, right, predicate='intersects', distance=None, output='sparse'):
+    """Boolean len(left) x len(right) matrix of `left[i] <predicate> right[j]`.
+
+    `output` is 'sparse' (scipy CSR matrix), 'dense' (NumPy array) or 'pairs'
+    (the (i, j) position arrays from `predicate_pairs`).
+    """
+    i, j = predicate_pairs(left, right, predicate, distance)
+    shape = (len(left), len(right))
+    if output == 'pairs':
+        return i, j
+    if output == 'sparse':
+        return scipy.sparse.csr_matrix((np.ones(len(i), dtype=bool), (i, j)), shape=shape)
+    if output == 'dense':
+        m = np.zeros(shape, dtype=bool)
+        m[i, j] = True
+        return m
+    raise ValueError("output must be 'sparse', 'dense' or 'pairs', not {!r}".format(output))
+
+
+def _mask_test(geoms, mask_wkb, predicate):
+    # a prepared copy of the mask per call, so threads never share one
+    mask = shapely.from_wkb(mask_wkb)
+    shapely.prepare(mask)
+    return getattr(shapely, CONVERSE[predicate])(mask, geoms)
+
+
+def mask_filter(geoms, mask, predicate='intersects', n_threads=None, chunk_size=50_000):
+    """Boolean array: which of `geoms` are `<predicate>` the single geometry `mask`.
+
+    For filtering many features against one (complex) polygon, e.g.
+    nz_height[mask_filter(nz_height, canterbury.geometry.iloc[0])]. Features
+    whose bounding box misses the mask's are ruled out without a geometric
+    test; the rest are tested against a prepared mask in chunks of
+    `chunk_size`, across `n_threads` threads (shapely releases the GIL).
+    `predicate` is 'intersects', 'within', 'covered_by' or 'disjoint'.
+    """
+    if predicate not in CONVERSE:
+        raise ValueError('predicate must be one of {}, not {!r}'.format(tuple(CONVERSE), predicate))
+    geoms = geometry_array(geoms)
+    xmin, ymin, xmax, ymax = shapely.bounds(geoms).T
+    mxmin, mymin, mxmax, mymax = mask.bounds
+    with np.errstate(invalid='ignore'):
+        # NaN bounds (empty or missing geometries) are never candidates
+        candidates = np.flatnonzero((xmin <= mxmax) & (xmax >= mxmin) & (ymin <= mymax) & (ymax >= mymin))
+    result = np.zeros(len(geoms), dtype=bool)
+    if len(candidates):
+        mask_wkb = shapely.to_wkb(mask)
+        chunks = [candidates[k:k + chunk_size] for k in range(0, len(candidates), chunk_size)]
+        n_threads = min(n_threads or os.cpu_count() or 1, len(chunks))
+        if n_threads > 1:
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                parts = list(pool.map(lambda c: _mask_test(geoms[c], mask_wkb, predicate), chunks))
+        else:
+            parts = [_mask_test(geoms[c], mask_wkb, predicate) for c in chunks]
+        result[candidates] = np.concatenate(parts)
+    if predicate == 'disjoint':
+        result = ~result & ~shapely.is_missing(geoms)
+    return result
+
+
+def any_filter(geoms, mask, predicate='intersects', distance=None):
+    """Boolean array: which of `geoms` intersect (or are within `distance` of) any of `mask`.
+
+    Gives the same answer as `geoms.intersects(mask.union_all())` without
+    building the union: the mask parts are put in an STRtree and queried
+    once. `predicate` is 'intersects', 'dwithin' (needs `distance`) or
+    'disjoint' (the negation of 'intersects'). Predicates such as 'within'
+    are not included, as being within a union is not the same as being
+    within one of its parts.
+    """
+    if predicate not in ('intersects', 'dwithin', 'disjoint'):
+        raise ValueError("predicate must be 'intersects', 'dwithin' or 'disjoint', not {!r}".format(predicate))
+    if predicate == 'dwithin' and distance is None:
+        raise ValueError("predicate 'dwithin' needs a distance")
+    geoms = geometry_array(geoms)
+    tree = shapely.STRtree(geometry_array(mask))
+    query = 'intersects' if predicate == 'disjoint' else predicate
+    i, _ = tree.query(geoms, predicate=query, distance=distance)
+    result = np.zeros(len(geoms), dtype=bool)
+    result[i] = True
+    if predicate == 'disjoint':
+        result = ~result & ~shapely.is_missing(geoms)
+    return result
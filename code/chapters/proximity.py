@@ -0,0 +1,62 @@
+import numpy as np
+import scipy.ndimage
+import shapely
+import rasterio.features
+
+from inputs import geometry_array
+
+
+def cell_centres(transform, rows, cols):
+    """x and y coordinates of the centres of cells (rows, cols), broadcast together."""
+    rows, cols = np.asarray(rows) + 0.5, np.asarray(cols) + 0.5
+    x = transform.c + cols * transform.a + rows * transform.b
+    y = transform.f + cols * transform.d + rows * transform.e
+    return x, y
+
+
+def proximity(geoms, out_shape, transform, method='edt', mask=None, all_touched=True, block_rows=256):
+    """Distance from each cell centre of a grid to the nearest of `geoms`.
+
+    The grid is given as for rasterio.features.rasterize, so the result is
+    aligned with the raster it comes from, e.g. for the chapter's coastline
+    example: proximity(coastline, r.shape, new_transform, mask=~np.isnan(r)).
+
+    method='edt': rasterize `geoms` once (with `all_touched`) and run a
+        Euclidean distance transform; the distance is to the nearest centre
+        of a touched cell, so it can be off by up to about half a cell
+        diagonal. Fast at any resolution.
+    method='exact': the true distance to the geometries, computed
+        `block_rows` rows at a time with one bulk STRtree nearest query.
+    Cells outside `mask` (a boolean array of `out_shape`) are NaN, and are
+    skipped by the 'exact' method.
+    """
+    geoms = geometry_array(geoms)
+    if transform.b != 0 or transform.d != 0:
+        raise ValueError('rotated grids are not supported')
+    if mask is not None and np.shape(mask) != tuple(out_shape):
+        raise ValueError('mask must have shape {}'.format(tuple(out_shape)))
+    height, width = out_shape
+    if method == 'edt':
+        target = rasterio.features.rasterize(
+            ((g, 1) for g in geoms if g is not None and not g.is_empty),
+            out_shape=out_shape, transform=transform, fill=0, all_touched=all_touched, dtype=np.uint8)
+        if not target.any():
+            raise ValueError('no geometry falls on the grid')
+        out = scipy.ndimage.distance_transform_edt(target == 0, sampling=(abs(transform.e), abs(transform.a)))
+    elif method == 'exact':
+        tree = shapely.STRtree(geoms)
+        out = np.full((height, width), np.nan)
+        cols = np.arange(width)
+        for row0 in range(0, height, block_rows):
+            rows = np.arange(row0, min(row0 + block_rows, height))
+            x, y = cell_centres(transform, rows[:, None], cols[None, :])
+            todo = np.ones(x.shape, dtype=bool) if mask is None else np.asarray(mask[rows], dtype=bool)
+            (i, _), d = tree.query_nearest(shapely.points(x[todo], y[todo]), return_distance=True, all_matches=False)
+            block = out[rows]
+            block[todo] = d[np.argsort(i)]
+            out[rows] = block
+    else:
+        raise ValueError("method must be 'edt' or 'exact', not {!r}".format(method))
+    if mask is not None:
+        out[~np.asarray(mask, dtype=bool)] = np.nan
+    return out
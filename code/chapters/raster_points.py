@@ -0,0 +1,92 @@
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+from rasterio.windows import Window
+
+from proximity import cell_centres
+from inputs import open_raster
+
+
+def iter_points(src, indexes=None, skip_nodata=True, block_rows=1000):
+    """Yield the cells of a raster as points, in GeoDataFrames of `block_rows` raster rows.
+
+    `src` is a rasterio dataset or a file path. Points are the cell centres,
+    computed from the transform for the cells of each block only, with the
+    values of bands `indexes` (by default all) in the column 'value' for a
+    single band, or 'band_1', 'band_2', ... otherwise; 'row' and 'col' give
+    the cell. With `skip_nodata`, cells that are nodata or NaN in every band
+    are dropped before any geometry is made.
+    """
+    with open_raster(src) as src:
+        if indexes is None:
+            indexes = src.indexes
+        indexes = [indexes] if np.isscalar(indexes) else list(indexes)
+        names = ['value'] if len(indexes) == 1 else ['band_{}'.format(i) for i in indexes]
+        cols = np.arange(src.width)
+        # kept cells can still be nodata in some bands; those become NaN, in
+        # float columns for every block alike
+        gaps = src.nodata is not None and (len(indexes) > 1 or not skip_nodata)
+        for row0 in range(0, src.height, block_rows):
+            window = Window(0, row0, src.width, min(block_rows, src.height - row0))
+            data = src.read(indexes, window=window, masked=True)
+            missing = np.ma.getmaskarray(data)
+            if np.issubdtype(data.dtype, np.floating):
+                missing |= np.isnan(data.data)
+            keep = ~missing.all(axis=0) if skip_nodata else np.ones(missing.shape[1:], dtype=bool)
+            rows, cc = np.nonzero(keep)
+            if not len(rows):
+                continue
+            rows += row0
+            x, y = cell_centres(src.transform, rows, cols[cc])
+            values = {}
+            for k, name in enumerate(names):
+                v = data.data[k][keep]
+                if gaps:
+                    v = v.astype(np.float64)
+                    v[missing[k][keep]] = np.nan
+                values[name] = v
+            yield gpd.GeoDataFrame(dict(values, row=rows, col=cc), geometry=shapely.points(x, y), crs=src.crs)
+
+
+def raster_to_points(src, indexes=None, skip_nodata=True):
+    # the whole raster as one GeoDataFrame of points
+    blocks = list(iter_points(src, indexes, skip_nodata))
+    with open_raster(src) as ds:
+        crs = ds.crs
+    if not blocks:
+        return gpd.GeoDataFrame(geometry=gpd.GeoSeries([], crs=crs))
+    return gpd.GeoDataFrame(pd.concat(blocks, ignore_index=True), crs=crs)
+
+
+def write_points(path, src, indexes=None, skip_nodata=True, block_rows=1000, **kwargs):
+    """Write the points of a raster to a file, one block of raster rows at a time.
+
+    Paths ending with '.parquet' get GeoParquet, written as one row group
+    per block with pyarrow; anything else is written with GeoDataFrame.to_file
+    (e.g. GeoPackage), passing on `kwargs`.
+    """
+    blocks = iter_points(src, indexes, skip_nodata, block_rows)
+    if not str(path).endswith('.parquet'):
+        for i, block in enumerate(blocks):
+            block.to_file(path, mode='w' if i == 0 else 'a', **kwargs)
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    try:
+        for block in blocks:
+            table = pa.Table.from_pandas(block.drop(columns='geometry'), preserve_index=False)
+            table = table.append_column('geometry', pa.array(shapely.to_wkb(block.geometry.values), pa.binary()))
+            if writer is None:
+                geo = {'version': '1.0.0', 'primary_column': 'geometry',
+                       'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point'],
+                                                'crs': block.crs.to_json_dict() if block.crs else None}}}
+                schema = table.schema.with_metadata({b'geo': json.dumps(geo).encode()})
+                writer = pq.ParquetWriter(path, schema, **kwargs)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
@@ -0,0 +1,73 @@
+import numpy as np
+import shapely
+import rasterio
+import rasterio.features
+from rasterio.enums import MergeAlg
+from rasterio.windows import transform as window_transform
+
+from focal import map_bounded, tiled_profile, tiles
+from inputs import geometry_array
+
+
+def tile_features(geoms, windows, transform):
+    """Positions of the features intersecting each window, as one list of arrays.
+
+    One bulk STRtree query of the windows' footprints, each grown by half a
+    cell so that features on a tile edge go to both tiles; a feature only
+    burns the cells of the tile it is rasterized in, so extras are harmless.
+    """
+    xres, yres = abs(transform.a), abs(transform.e)
+    boxes = []
+    for window in windows:
+        left, bottom, right, top = rasterio.windows.bounds(window, transform)
+        boxes.append((left - xres / 2, bottom - yres / 2, right + xres / 2, top + yres / 2))
+    tree = shapely.STRtree(geoms)
+    t, i = tree.query(shapely.box(*np.array(boxes).T), predicate='intersects')
+    # keep the features in their original order within each tile, so that
+    # with merge_alg='replace' the last one wins, as with a single rasterize
+    order = np.lexsort((i, t))
+    t, i = t[order], i[order]
+    return np.split(i, np.searchsorted(t, np.arange(1, len(windows))))
+
+
+def rasterize_tiles(geoms, dst_path, out_shape, transform, values=1, crs=None, fill=0,
+                    all_touched=False, merge_alg='replace', dtype='float64', nodata=None,
+                    block_size=512, n_threads=None, **profile):
+    """Rasterize `geoms` straight into a tiled GeoTIFF, one tile at a time.
+
+    Gives the same raster as rasterio.features.rasterize with the same
+    `out_shape`, `transform`, `fill`, `all_touched` and `merge_alg`
+    ('replace' or 'add', or a MergeAlg), but the output is never held in
+    memory as a whole: the grid is split into `block_size` tiles, an STRtree
+    finds the features that intersect each tile, and the tiles are
+    rasterized in `n_threads` threads and written as they are done.
+    `values` is one value for all features, or one per feature (e.g. a
+    column); features with a NaN value are skipped, as in the chapter's
+    .dropna(subset='capacity'). Extra keyword arguments update the profile.
+    """
+    merge_alg = MergeAlg[merge_alg] if isinstance(merge_alg, str) else merge_alg
+    geoms = geometry_array(geoms)
+    values = np.broadcast_to(np.asarray(values, dtype=np.float64), len(geoms))
+    keep = ~np.isnan(values) & ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)
+    geoms, values = geoms[keep], values[keep]
+    height, width = out_shape
+    windows = tiles(height, width, block_size)
+    features = tile_features(geoms, windows, transform)
+
+    def work(k):
+        window = windows[k]
+        shape = (window.height, window.width)
+        if not len(features[k]):
+            return np.full(shape, fill, dtype=dtype)
+        return rasterio.features.rasterize(
+            zip(geoms[features[k]], values[features[k]]), out_shape=shape,
+            transform=window_transform(window, transform), fill=fill, all_touched=all_touched,
+            merge_alg=merge_alg, dtype=dtype)
+
+    out_profile = tiled_profile({}, block_size, width=width, height=height, count=1, dtype=dtype,
+                                crs=crs, transform=transform, nodata=nodata)
+    out_profile.update(profile)
+    with rasterio.open(dst_path, 'w', **out_profile) as dst:
+        for window, out in zip(windows, map_bounded(work, range(len(windows)), n_threads)):
+            dst.write(out, 1, window=window)
+    return dst_path
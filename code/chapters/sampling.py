@@ -0,0 +1,94 @@
+import numpy as np
+import pyproj
+import shapely
+from rasterio.windows import Window
+
+from inputs import open_raster
+
+
+def _coords(points, crs):
+    # x and y arrays, and their CRS, from a GeoSeries/GeoDataFrame or an (x, y)
+    # pair; one entry per row, NaN for empty or missing points
+    if hasattr(points, 'geometry') or hasattr(points, 'crs'):
+        crs = crs or points.crs
+        geoms = np.asarray(getattr(points, 'geometry', points).values, dtype=object)
+        types = shapely.get_type_id(geoms)
+        if ((types != 0) & (types != -1)).any():
+            raise ValueError('points must be Point geometries')
+        x, y = np.full(len(geoms), np.nan), np.full(len(geoms), np.nan)
+        ok = (types == 0) & ~shapely.is_empty(geoms)
+        x[ok], y[ok] = shapely.get_x(geoms[ok]), shapely.get_y(geoms[ok])
+        return x, y, crs
+    x, y = points
+    return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), crs
+
+
+def _read_cells(src, rows, cols, indexes):
+    # values of cells (rows, cols) as float, NaN where outside the raster or
+    # nodata; only the internal blocks that hold at least one cell are read
+    out = np.full((len(rows), len(indexes)), np.nan)
+    inside = np.flatnonzero((rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width))
+    bh, bw = src.block_shapes[0]
+    nbx = -(-src.width // bw)
+    blocks = rows[inside] // bh * nbx + cols[inside] // bw
+    order = np.argsort(blocks, kind='stable')
+    inside, blocks = inside[order], blocks[order]
+    starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+    for k0, k1 in zip(starts, np.r_[starts[1:], len(blocks)]):
+        cells = inside[k0:k1]
+        row0, col0 = blocks[k0] // nbx * bh, blocks[k0] % nbx * bw
+        window = Window(col0, row0, min(bw, src.width - col0), min(bh, src.height - row0))
+        data = src.read(indexes, window=window, masked=True)
+        r, c = rows[cells] - row0, cols[cells] - col0
+        values = data.data[:, r, c].T.astype(np.float64)
+        values[np.ma.getmaskarray(data)[:, r, c].T] = np.nan
+        out[cells] = values
+    return out
+
+
+def sample(src, points, indexes=1, method='nearest', crs=None):
+    """Raster values at many points at once.
+
+    `src` is a rasterio dataset or a file path. `points` is a GeoSeries or
+    GeoDataFrame of points, or a pair of coordinate arrays (x, y) in `crs`
+    (by default the raster's); points in another CRS than the raster's are
+    transformed first. Cell positions are computed for all points together,
+    and only the raster's internal blocks that hold points are read.
+
+    method='nearest': the value of the cell the point falls in (as
+        src.sample and rasterstats.point_query(..., interpolate='nearest')).
+    method='bilinear': interpolated from the four nearest cell centres,
+        using the ones that are not nodata.
+    Returns a float array with one value per point for a single band index,
+    or one column per band for a list of `indexes`; points outside the
+    raster, on nodata cells, or empty or missing get NaN. Other geometry
+    types than points raise a ValueError.
+    """
+    if method not in ('nearest', 'bilinear'):
+        raise ValueError("method must be 'nearest' or 'bilinear', not {!r}".format(method))
+    x, y, crs = _coords(points, crs)
+    with open_raster(src) as src:
+        if crs is not None and src.crs is not None and pyproj.CRS(crs) != pyproj.CRS(src.crs):
+            x, y = pyproj.Transformer.from_crs(crs, src.crs, always_xy=True).transform(x, y)
+        single = np.isscalar(indexes)
+        indexes = [indexes] if single else list(indexes)
+        col, row = ~src.transform * (np.asarray(x), np.asarray(y))
+        # points without coordinates fall outside the raster, so get NaN
+        unknown = ~np.isfinite(col) | ~np.isfinite(row)
+        col, row = np.where(unknown, -1, col), np.where(unknown, -1, row)
+        if method == 'nearest':
+            out = _read_cells(src, np.floor(row).astype(np.int64), np.floor(col).astype(np.int64), indexes)
+        else:
+            # the four cells whose centres surround each point
+            row, col = row - 0.5, col - 0.5
+            r0, c0 = np.floor(row).astype(np.int64), np.floor(col).astype(np.int64)
+            fr, fc = (row - r0)[:, None], (col - c0)[:, None]
+            rows = np.concatenate([r0, r0, r0 + 1, r0 + 1])
+            cols = np.concatenate([c0, c0 + 1, c0, c0 + 1])
+            values = _read_cells(src, rows, cols, indexes).reshape(4, len(r0), len(indexes))
+            weights = np.stack([(1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc])
+            weights = np.where(np.isnan(values), 0, np.broadcast_to(weights, values.shape))
+            with np.errstate(invalid='ignore'):
+                out = (weights * np.nan_to_num(values)).sum(axis=0) / weights.sum(axis=0)
+            out[(weights == 0).all(axis=0)] = np.nan
+    return out[:, 0] if single else out
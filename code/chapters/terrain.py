@@ -0,0 +1,99 @@
+import numpy as np
+import rasterio
+
+from focal import PAD_MODES, edge_mask, map_tiles, read_halo, tiled_profile, tiles
+
+METRICS = ('slope', 'aspect', 'hillshade', 'curvature', 'tpi')
+
+
+def _metrics(p, xres, yres, metrics, azimuth, altitude):
+    # all metrics from the nine shifted views of one padded block, with the
+    # Horn (1981) gradient that gdaldem uses by default
+    a, b, c = p[:-2, :-2], p[:-2, 1:-1], p[:-2, 2:]
+    d, e, f = p[1:-1, :-2], p[1:-1, 1:-1], p[1:-1, 2:]
+    g, h, i = p[2:, :-2], p[2:, 1:-1], p[2:, 2:]
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * xres)
+    dzdy = ((a + 2 * b + c) - (g + 2 * h + i)) / (8 * yres)  # towards north
+    slope = np.arctan(np.hypot(dzdx, dzdy))
+    # downslope direction, clockwise from north; NaN where flat
+    aspect = np.degrees(np.arctan2(-dzdx, -dzdy)) % 360
+    aspect[(dzdx == 0) & (dzdy == 0)] = np.nan
+    out = {}
+    if 'slope' in metrics:
+        out['slope'] = np.degrees(slope)
+    if 'aspect' in metrics:
+        out['aspect'] = aspect
+    if 'hillshade' in metrics:
+        zenith = np.radians(90 - altitude)
+        shade = np.cos(zenith) * np.cos(slope) + \
+            np.sin(zenith) * np.sin(slope) * np.cos(np.radians(azimuth - np.nan_to_num(aspect)))
+        shade = 255 * np.clip(shade, 0, None)
+        shade[np.isnan(slope)] = np.nan
+        out['hillshade'] = shade
+    if 'curvature' in metrics:
+        # Zevenbergen and Thorne (1987), as in ArcGIS: positive is convex
+        out['curvature'] = -2 * (((d + f) / 2 - e) / xres ** 2 + ((b + h) / 2 - e) / yres ** 2) * 100
+    if 'tpi' in metrics:
+        out['tpi'] = e - (a + b + c + d + f + g + h + i) / 8
+    return out
+
+
+def terrain(src_path, metrics=('slope', 'aspect'), dst_paths=None, z_factor=1, azimuth=315,
+            altitude=45, edges='nan', band=1, block_size=512, n_threads=None, dtype='float32'):
+    """Terrain metrics of a DEM, computed in one pass over 3 x 3 neighbourhoods.
+
+    metrics: any of 'slope' (degrees, 0-90), 'aspect' (degrees clockwise
+    from north, 0-360, NaN where flat), 'hillshade' (0-255, lit from
+    `azimuth` and `altitude` in degrees), 'curvature' (as ArcGIS, in
+    1/100 z units, positive is convex) and 'tpi' (topographic position index:
+    elevation minus the mean of the 8 neighbours). Slope, aspect and
+    hillshade match `gdaldem`. `z_factor` converts elevation to the units
+    of the cell size (e.g. feet to metres).
+    The DEM is read once, in `block_size` tiles with a one-cell halo, and
+    the tiles are processed in `n_threads` threads. Without `dst_paths`,
+    returns a dict of arrays; with a dict such as {'slope': 'output/slope.tif'},
+    each metric is written block by block to its own GeoTIFF instead.
+    Cells next to nodata get NaN; so do the raster's outer cells with
+    edges='nan', while 'nearest' and 'reflect' extend the DEM beyond them.
+    """
+    metrics = [metrics] if isinstance(metrics, str) else list(metrics)
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        raise ValueError('unknown metrics: {}'.format(', '.join(sorted(unknown))))
+    if dst_paths is not None and set(dst_paths) != set(metrics):
+        raise ValueError('dst_paths must have one path per metric')
+    if edges not in ('nan',) + tuple(PAD_MODES):
+        raise ValueError("edges must be 'nan', 'reflect' or 'nearest', not {!r}".format(edges))
+
+    with rasterio.open(src_path) as src:
+        height, width = src.height, src.width
+        xres, yres = src.res
+        profile = src.profile.copy()
+
+    def work(src, window):
+        p = read_halo(src, band, window, 1, 1, edges) * z_factor
+        out = _metrics(p, xres, yres, metrics, azimuth, altitude)
+        if edges == 'nan':
+            edge = edge_mask(window, 1, 1, height, width)
+            for arr in out.values():
+                arr[edge] = np.nan
+        return out
+
+    blocks = map_tiles(src_path, work, tiles(height, width, block_size), n_threads)
+    if dst_paths is None:
+        result = {m: np.empty((height, width), dtype=dtype) for m in metrics}
+        for window, out in blocks:
+            rows, cols = window.toslices()
+            for m in metrics:
+                result[m][rows, cols] = out[m]
+        return result
+    profile = tiled_profile(profile, block_size, count=1, dtype=dtype, nodata=np.nan)
+    dsts = {m: rasterio.open(dst_paths[m], 'w', **profile) for m in metrics}
+    try:
+        for window, out in blocks:
+            for m in metrics:
+                dsts[m].write(out[m].astype(dtype), 1, window=window)
+    finally:
+        for dst in dsts.values():
+            dst.close()
+    return dst_paths
@@ -0,0 +1,223 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+import rasterio
+import rasterio.features
+import geopandas as gpd
+
+from inputs import open_raster
+
+STATS = ('count', 'sum', 'mean', 'min', 'max', 'std')
+
+
+class _Zones:
+    # running count, sum, M2 (sum of squared deviations), min and max per zone,
+    # merged block by block with Chan et al.'s pairwise formula for the variance
+    def __init__(self):
+        self.zones = np.zeros(0)
+        self.count = np.zeros(0)
+        self.sum = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+
+    def add(self, values, zones):
+        if not len(values):
+            return
+        keys, inv = np.unique(zones, return_inverse=True)
+        n = len(keys)
+        count = np.bincount(inv, minlength=n).astype(float)
+        total = np.bincount(inv, weights=values, minlength=n)
+        mean = total / count
+        m2 = np.bincount(inv, weights=(values - mean[inv]) ** 2, minlength=n)
+        vmin = np.full(n, np.inf)
+        vmax = np.full(n, -np.inf)
+        np.minimum.at(vmin, inv, values)
+        np.maximum.at(vmax, inv, values)
+        self._merge(keys, count, total, m2, vmin, vmax)
+
+    def _merge(self, keys, count, total, m2, vmin, vmax):
+        if not len(self.zones):
+            # keep the zones' own dtype
+            self.zones = self.zones.astype(keys.dtype)
+        all_keys = np.union1d(self.zones, keys)
+        old = np.searchsorted(all_keys, self.zones)
+        new = np.searchsorted(all_keys, keys)
+
+        def spread(values, at, fill):
+            out = np.full(len(all_keys), fill)
+            out[at] = values
+            return out
+
+        c1, c2 = spread(self.count, old, 0.0), spread(count, new, 0.0)
+        s1, s2 = spread(self.sum, old, 0.0), spread(total, new, 0.0)
+        c = c1 + c2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(c1 > 0, s1 / c1, 0) - np.where(c2 > 0, s2 / c2, 0)
+            cross = np.where(c > 0, delta ** 2 * c1 * c2 / c, 0)
+        self.m2 = spread(self.m2, old, 0.0) + spread(m2, new, 0.0) + cross
+        self.min = np.minimum(spread(self.min, old, np.inf), spread(vmin, new, np.inf))
+        self.max = np.maximum(spread(self.max, old, -np.inf), spread(vmax, new, -np.inf))
+        self.zones, self.count, self.sum = all_keys, c, s1 + s2
+
+    def table(self, stats):
+        cols = {
+            'count': self.count.astype(np.int64),
+            'sum': self.sum,
+            'mean': self.sum / self.count,
+            'min': self.min,
+            'max': self.max,
+            'std': np.sqrt(self.m2 / self.count),
+        }
+        df = pd.DataFrame({s: cols[s] for s in stats}, index=self.zones)
+        df.index.name = 'zone'
+        return df
+
+
+def _valid(values, zones, nodata, zones_nodata):
+    ok = ~np.isnan(values)
+    if nodata is not None:
+        ok &= values != nodata
+    if zones_nodata is not None:
+        ok &= zones != zones_nodata
+    if np.issubdtype(zones.dtype, np.floating):
+        ok &= ~np.isnan(zones)
+    return values[ok], zones[ok]
+
+
+def zonal_stats_by_raster(values, zones, stats=STATS, nodata=None, zones_nodata=None):
+    """Statistics of `values` for each category of `zones`, in one pass.
+
+    `values` and `zones` are either arrays of the same shape, or rasterio
+    datasets (or file paths) on the same grid; datasets are read block by
+    block, so rasters larger than memory are fine. Cells equal to `nodata`
+    (by default the datasets' own nodata values) or NaN are left out.
+    Returns a DataFrame with one row per zone and one column per statistic
+    ('count', 'sum', 'mean', 'min', 'max', 'std'), e.g. the chapter's
+    {i: elev[grain == i].mean() for i in np.unique(grain)} is
+    zonal_stats_by_raster(elev, grain)['mean'].
+    """
+    unknown = set(stats) - set(STATS)
+    if unknown:
+        raise ValueError('unknown statistics: {}'.format(', '.join(sorted(unknown))))
+    acc = _Zones()
+    if isinstance(values, np.ndarray):
+        if values.shape != np.shape(zones):
+            raise ValueError('values and zones must have the same shape')
+        v, z = _valid(values.astype(float).ravel(), np.asarray(zones).ravel(), nodata, zones_nodata)
+        acc.add(v, z)
+        return acc.table(stats)
+    with open_raster(values) as src_v, open_raster(zones) as src_z:
+        if src_v.shape != src_z.shape or src_v.transform != src_z.transform:
+            raise ValueError('values and zones must be on the same grid')
+        nodata = src_v.nodata if nodata is None else nodata
+        zones_nodata = src_z.nodata if zones_nodata is None else zones_nodata
+        for _, window in src_v.block_windows(1):
+            v = src_v.read(1, window=window).astype(float).ravel()
+            z = src_z.read(1, window=window).ravel()
+            acc.add(*_valid(v, z, nodata, zones_nodata))
+    return acc.table(stats)
+
+
+POLYGON_STATS = ('count', 'nodata', 'sum', 'mean', 'min', 'max', 'std', 'median', 'majority')
+
+
+def _polygon_stats(values, n_nodata, stats, percentiles):
+    out = {'count': len(values), 'nodata': n_nodata}
+    if not len(values):
+        return dict(out, **{s: np.nan for s in stats if s not in out},
+                    **{'p{:g}'.format(q): np.nan for q in percentiles})
+    for s in stats:
+        if s == 'sum':
+            out[s] = values.sum()
+        elif s == 'mean':
+            out[s] = values.mean()
+        elif s == 'min':
+            out[s] = values.min()
+        elif s == 'max':
+            out[s] = values.max()
+        elif s == 'std':
+            out[s] = values.std()
+        elif s == 'median':
+            out[s] = np.median(values)
+        elif s == 'majority':
+            classes, counts = np.unique(values, return_counts=True)
+            out[s] = classes[np.argmax(counts)]
+    for q, v in zip(percentiles, np.percentile(values, percentiles) if len(percentiles) else ()):
+        out['p{:g}'.format(q)] = v
+    return out
+
+
+def _polygon_chunk(path, wkbs, band, stats, percentiles, categorical, nodata, all_touched):
+    # statistics for a chunk of polygons; each reads only the window
+    # covering its bounds and rasterizes its own mask there
+    rows, hists = [], []
+    with rasterio.open(path) as src:
+        nodata = src.nodata if nodata is None else nodata
+        for geom in shapely.from_wkb(wkbs):
+            values, n_nodata = np.zeros(0), 0
+            if geom is not None and not geom.is_empty:
+                try:
+                    window = rasterio.features.geometry_window(src, [geom])
+                except rasterio.errors.WindowError:
+                    # the polygon is outside the raster
+                    window = None
+                if window is not None and window.width > 0 and window.height > 0:
+                    data = src.read(band, window=window).astype(float)
+                    inside = rasterio.features.geometry_mask(
+                        [geom], data.shape, src.window_transform(window), all_touched=all_touched, invert=True)
+                    missing = np.isnan(data) if nodata is None else np.isnan(data) | (data == nodata)
+                    values = data[inside & ~missing]
+                    n_nodata = int((inside & missing).sum())
+            rows.append(_polygon_stats(values, n_nodata, stats, percentiles))
+            if categorical:
+                classes, counts = np.unique(values, return_counts=True)
+                hists.append(dict(zip(classes, counts)))
+    return rows, hists
+
+
+def zonal_stats_by_polygons(polygons, path, stats=('mean', 'min', 'max'), percentiles=(),
+                            categorical=False, band=1, nodata=None, all_touched=False,
+                            chunk_size=100, n_jobs=None):
+    """Statistics of the raster file `path` within each of `polygons`.
+
+    Each polygon reads only the window covering its bounds and is rasterized
+    there, so the raster is never read as a whole; polygons are sent in
+    chunks of `chunk_size` to `n_jobs` processes when there are several
+    chunks. Polygons in another CRS than the raster's are transformed first.
+    stats: any of 'count', 'nodata' (number of nodata cells), 'sum',
+    'mean', 'min', 'max', 'std', 'median' and 'majority', as in
+    rasterstats.zonal_stats; `percentiles` (0-100) add columns such as 'p25'.
+    With `categorical`, adds the count of each raster value, in columns
+    'class_<value>', e.g. for land cover classes.
+    Returns a DataFrame with one row per polygon, on the index of `polygons`.
+    """
+    unknown = set(stats) - set(POLYGON_STATS)
+    if unknown:
+        raise ValueError('unknown statistics: {}'.format(', '.join(sorted(unknown))))
+    geoms = gpd.GeoSeries(getattr(polygons, 'geometry', polygons))
+    with rasterio.open(path) as src:
+        if geoms.crs is not None and src.crs is not None and geoms.crs != src.crs:
+            geoms = geoms.to_crs(src.crs)
+    wkbs = shapely.to_wkb(geoms.values)
+    chunks = [wkbs[k:k + chunk_size] for k in range(0, len(wkbs), chunk_size)]
+    args = (band, list(stats), list(percentiles), categorical, nodata, all_touched)
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            repeat = [[a] * len(chunks) for a in (path,) + args]
+            parts = list(pool.map(_polygon_chunk, repeat[0], chunks, *repeat[1:]))
+    else:
+        parts = [_polygon_chunk(path, c, *args) for c in chunks]
+    rows = [r for part in parts for r in part[0]]
+    columns = list(stats) + ['p{:g}'.format(q) for q in percentiles]
+    result = pd.DataFrame(rows, columns=columns, index=geoms.index)
+    if categorical:
+        hists = pd.DataFrame([h for part in parts for h in part[1]], index=geoms.index)
+        hists = hists.reindex(columns=sorted(hists.columns)).fillna(0).astype(np.int64)
+        hists.columns = ['class_{:g}'.format(c) for c in hists.columns]
+        result = pd.concat([result, hists], axis=1)
+    return result
@@ -0,0 +1,313 @@
+# Aim: run the chapter scripts, in parallel where their data dependencies allow
+#
+# The files each chapter reads and writes under data/ and output/ are found by
+# scanning its code, e.g. chapter 01 writes output/elev.tif, which chapters
+# 02-05 read, so those wait for it. Independent chapters run at the same time.
+# Files fetched with book_data.get_data/get_file are read after the first
+# chapter that fetches them, and chapters fetching or writing the same file
+# run one after the other, so two chapters never download a file at once.
+#
+# A chapter is skipped when neither its code, the local modules it imports
+# (e.g. map_to_png.py, book_data.py) nor any file it reads has changed since
+# its last successful run, and the files it writes (including the figures
+# map_to_png saves in images/) are still there.
+#
+# Usage (from the repository root):
+#   python code/run_chapters.py                 # all chapters
+#   python code/run_chapters.py 03 06 -j 4      # chapters 03 and 06 (plus what they need)
+#   python code/run_chapters.py --dry-run       # show the dependencies only
+#   python code/run_chapters.py --force         # run even if nothing changed
+#   python code/run_chapters.py --cell-cache    # reuse slow cells (see cell_cache.py)
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+CHAPTERS = ROOT / 'code' / 'chapters'
+LOG_DIR = ROOT / '.cache' / 'run_chapters'
+STATE = LOG_DIR / 'state.json'
+
+# 'data/...' or 'output/...' inside a string
+PATH_RE = re.compile(r'''\b((?:data|output)/[\w.-][\w./-]*)''')
+# a path argument followed by a write mode, e.g. rasterio.open('output/r.tif', 'w', ...)
+WRITE_MODE_RE = re.compile(r'''^['"]\s*,\s*(?:mode\s*=\s*)?['"](?:w|r\+|a)['"]''')
+WRITE_CALLS = ('.to_file(', '.savefig(', '.to_csv(', '.save(', 'urlretrieve(')
+# commands whose last path argument is the output
+COPY_CALLS = ('os.system(', 'shutil.copy', 'subprocess.')
+# book_data calls: every path argument is fetched, i.e. written
+FETCH_CALLS = ('get_data(', 'get_file(')
+# a whole directory, as in get_data('data/', 'output/')
+DIR_RE = re.compile(r'''['"]((?:data|output)/)['"]''')
+MANIFEST = ROOT / 'data.sha256'
+# map_to_png.map_to_png(m, 'fig-...') saves images/fig-....png
+FIG_RE = re.compile(r'''map_to_png\((?:[^()]|\([^()]*\))*?['"](fig-[\w-]+)['"]\s*\)''', re.DOTALL)
+# where the chapters' own imports are found (see run_one)
+MODULE_DIRS = (ROOT, CHAPTERS)
+
+
+def find_chapters():
+    return sorted(p for p in CHAPTERS.glob('[0-9][0-9]-*.py'))
+
+
+def manifest_names():
+    # the files listed in data.sha256 (see book_data.py)
+    if not MANIFEST.is_file():
+        return []
+    return [l.split(maxsplit=1)[1].strip() for l in MANIFEST.read_text().splitlines() if l.strip()]
+
+
+def scan(path):
+    # return (files read, files written, files fetched) by the script at `path`
+    reads, writes, fetches = set(), set(), set()
+    text = path.read_text(encoding='utf-8')
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        start = offset
+        offset += len(line)
+        if line.lstrip().startswith('#'):
+            continue
+        found = list(PATH_RE.finditer(line))
+        if any(c in line for c in FETCH_CALLS):
+            fetches.update(m.group(1) for m in found)
+            for d in DIR_RE.findall(line):
+                fetches.update(n for n in manifest_names() if n.startswith(d))
+            continue
+        for i, m in enumerate(found):
+            name = m.group(1)
+            after = text[start + m.end():start + m.end() + 40]
+            if (WRITE_MODE_RE.match(after)
+                    or any(c in line for c in WRITE_CALLS)
+                    or (any(c in line for c in COPY_CALLS) and i == len(found) - 1)):
+                writes.add(name)
+            else:
+                reads.add(name)
+    writes.update('images/{}.png'.format(name) for name in FIG_RE.findall(text))
+    return reads - writes - fetches, writes, fetches
+
+
+def code_lines(path):
+    # the code cells only, so that editing the text does not trigger a re-run
+    lines = path.read_text(encoding='utf-8').splitlines()
+    return [l.rstrip() for l in lines if l.strip() and not l.lstrip().startswith('#')]
+
+
+def local_modules(path, found=None):
+    # the modules in MODULE_DIRS that `path` imports, directly or not
+    found = set() if found is None else found
+    try:
+        tree = ast.parse(path.read_text(encoding='utf-8'))
+    except SyntaxError:
+        return found
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split('.')[0])
+    for name in sorted(names):
+        for d in MODULE_DIRS:
+            module = d / (name + '.py')
+            if module.is_file() and module not in found:
+                found.add(module)
+                local_modules(module, found)
+                break
+    return found
+
+
+def _hash_file(h, p):
+    with open(p, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(chunk)
+
+
+def fingerprint(chapter, reads):
+    h = hashlib.sha256()
+    h.update('\n'.join(code_lines(chapter)).encode('utf-8'))
+    for module in sorted(local_modules(chapter)):
+        h.update(module.relative_to(ROOT).as_posix().encode('utf-8'))
+        _hash_file(h, module)
+    for name in sorted(reads):
+        p = ROOT / name
+        h.update(name.encode('utf-8'))
+        if p.is_file():
+            _hash_file(h, p)
+    return h.hexdigest()
+
+
+def load_state():
+    if STATE.is_file():
+        return json.loads(STATE.read_text())
+    return {}
+
+
+def save_state(state):
+    STATE.parent.mkdir(parents=True, exist_ok=True)
+    STATE.write_text(json.dumps(state, indent=1, sort_keys=True))
+
+
+def build_graph(chapters):
+    # {chapter: set of chapters it has to wait for}
+    io = {c: scan(c) for c in chapters}
+    producers, fetchers = {}, {}
+    for c, (_, writes, fetches) in io.items():
+        for name in writes:
+            producers.setdefault(name, set()).add(c)
+        for name in fetches:
+            fetchers.setdefault(name, set()).add(c)
+    deps = {}
+    for c, (reads, _, _) in io.items():
+        deps[c] = set()
+        for name in reads:
+            if name in producers:
+                deps[c] |= producers[name] - {c}
+            elif name in fetchers:
+                # fetching again later is a no-op, so the first one is enough
+                deps[c] |= {min(fetchers[name])} - {c}
+    # chapters fetching or writing the same file (e.g. both fetching
+    # data/landsat.tif) run in chapter order
+    for name in set(producers) | set(fetchers):
+        ordered = sorted(producers.get(name, set()) | fetchers.get(name, set()))
+        for before, after in zip(ordered, ordered[1:]):
+            deps[after].add(before)
+    return deps, io
+
+
+def with_upstream(selected, deps):
+    todo, keep = list(selected), set()
+    while todo:
+        c = todo.pop()
+        if c not in keep:
+            keep.add(c)
+            todo.extend(deps[c])
+    return keep
+
+
+def check_acyclic(deps):
+    state = {}
+
+    def visit(c, trail):
+        if state.get(c) == 'done':
+            return
+        if state.get(c) == 'active':
+            names = [p.stem for p in trail + [c]]
+            raise SystemExit('Circular chapter dependency: ' + ' -> '.join(names))
+        state[c] = 'active'
+        for d in deps[c]:
+            visit(d, trail + [c])
+        state[c] = 'done'
+
+    for c in deps:
+        visit(c, [])
+
+
+def run_one(chapter, cell_cache=False):
+    # run a chapter script in its own process; return (exit code, seconds, peak RSS in MB)
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(ROOT), str(CHAPTERS), env.get('PYTHONPATH')]))
+    env.setdefault('MPLBACKEND', 'Agg')
+    start = time.perf_counter()
+    with open(LOG_DIR / (chapter.stem + '.log'), 'w') as log:
+        cmd = [sys.executable, str(chapter)]
+        if cell_cache:
+            cmd.insert(1, str(Path(__file__).with_name('cell_cache.py')))
+        p = subprocess.Popen(cmd, cwd=ROOT, env=env,
+                             stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(p.pid, 0)
+    # tell Popen the process has been reaped
+    p.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = usage.ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+    return p.returncode, seconds, rss
+
+
+def report(c, seconds, rss, status):
+    print('{:<28} {:>8.1f} s {:>8.0f} MB  {}'.format(c.stem, seconds, rss, status), flush=True)
+
+
+def run(deps, io, jobs, force=False, cell_cache=False):
+    results = {}
+    pending = dict(deps)
+    running = {}
+    state = load_state()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            for c in sorted(pending):
+                failed = [d for d in pending[c] if d in results and results[d][0] != 0]
+                if failed:
+                    results[c] = (None, 0.0, 0.0)
+                    del pending[c]
+                elif all(d in results for d in pending[c]):
+                    # upstream chapters are done, so the files read are final
+                    reads, writes, fetches = io[c]
+                    # the files a chapter fetches are read by it too
+                    fp = fingerprint(c, reads | fetches)
+                    del pending[c]
+                    up_to_date = (state.get(c.stem) == fp
+                                  and all((ROOT / name).is_file() for name in writes))
+                    if up_to_date and not force:
+                        results[c] = (0, 0.0, 0.0)
+                        report(c, 0.0, 0.0, 'up to date')
+                    else:
+                        running[pool.submit(run_one, c, cell_cache)] = c
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                c = running.pop(f)
+                results[c] = f.result()
+                code, seconds, rss = results[c]
+                if code == 0:
+                    # hashed again, as the files it fetched are only there now
+                    state[c.stem] = fingerprint(c, io[c][0] | io[c][2])
+                else:
+                    state.pop(c.stem, None)
+                save_state(state)
+                report(c, seconds, rss, 'ok' if code == 0 else 'FAILED ({})'.format(code))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the chapter scripts.')
+    parser.add_argument('chapters', nargs='*', help='chapter numbers or names, e.g. 03 (default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='chapters to run at once')
+    parser.add_argument('--dry-run', action='store_true', help='print the dependencies and exit')
+    parser.add_argument('--force', action='store_true', help='run chapters even if nothing changed')
+    parser.add_argument('--cell-cache', action='store_true', help='reuse the results of slow cells')
+    args = parser.parse_args(argv)
+
+    chapters = find_chapters()
+    deps, io = build_graph(chapters)
+    check_acyclic(deps)
+    if args.chapters:
+        selected = [c for c in chapters if any(c.stem.startswith(a) for a in args.chapters)]
+        keep = with_upstream(selected, deps)
+        deps = {c: d for c, d in deps.items() if c in keep}
+
+    if args.dry_run:
+        for c in deps:
+            after = ', '.join(sorted(d.stem for d in deps[c])) or '-'
+            print('{:<28} after: {}'.format(c.stem, after))
+        return 0
+
+    results = run(deps, io, args.jobs, force=args.force, cell_cache=args.cell_cache)
+    skipped = sorted(c.stem for c, r in results.items() if r[0] is None)
+    if skipped:
+        print('Skipped (upstream failed):', ', '.join(skipped))
+    print('Logs in', LOG_DIR)
+    return 0 if all(r[0] == 0 for r in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
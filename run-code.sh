@@ -1,7 +1,8 @@
 # Aim: run all Python scripts in code folder for testing outputs
 
-# These are failing: 
-# for f in code/chapters/*.py; do python "$f"; done
-# for f in ipynb/*.ipynb; do ipython "$f"; done
+# Chapters run in parallel, each after the chapters whose output/ files it
+# reads; timings, peak memory and log locations are printed at the end
+python code/run_chapters.py "$@"
 
-for f in ipynb/*.ipynb; do jupyter nbconvert --execute --to html "$f"; done
+# To execute the notebooks instead:
+# for f in ipynb/*.ipynb; do jupyter nbconvert --execute --to html "$f"; done
@@ -1,2 +1,3 @@
+python book_data.py --manifest
 zip -r data.zip data
 Rscript -e "piggyback::pb_upload('data.zip', 'geocompr/py')"